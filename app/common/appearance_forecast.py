@@ -0,0 +1,213 @@
+"""Прогноз следующего появления редких предметов (Secret/Godly).
+
+Для каждого предмета хранится гистограмма интервалов между соседними
+появлениями с шагом в минуту. Прогноз - условное распределение: среди
+интервалов длиннее уже прошедшего времени берутся квантили оставшегося.
+Гистограмма строится по всей истории векторно в NumPy и дополняется каждым
+новым стоком за O(1); накопленная сумма для прогноза пересчитывается только
+после изменения гистограммы.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import numpy as np
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+from app.common.item_stats import EPOCH, load_history, naive_utc, stock_items
+from app.common.items import AVAILABLE_ITEMS
+
+logger = logging.getLogger(__name__)
+
+FORECAST_RARITIES = ('Secret', 'Godly')
+# Интервалы длиннее попадают в последнюю корзину гистограммы
+FORECAST_MAX_GAP_MINUTES = int(os.getenv('FORECAST_MAX_GAP_MINUTES', str(14 * 24 * 60)))
+# Меньше интервалов - прогноз не строится
+FORECAST_MIN_GAPS = int(os.getenv('FORECAST_MIN_GAPS', '3'))
+# Квантили оставшегося времени: нижняя граница, медиана, верхняя граница
+FORECAST_QUANTILES = np.array([0.1, 0.5, 0.9])
+
+RARE_ITEM_IDS = [item_id for item_id, item_info in AVAILABLE_ITEMS.items() if item_info['rarity'] in FORECAST_RARITIES]
+
+
+class Forecast:
+    def __init__(
+        self,
+        item_id: str,
+        last_seen: datetime,
+        elapsed_minutes: float,
+        samples: int,
+        low: Optional[float] = None,
+        median: Optional[float] = None,
+        high: Optional[float] = None,
+        chance_hour: Optional[float] = None,
+    ):
+        self.item_id = item_id
+        self.last_seen = last_seen
+        self.elapsed_minutes = elapsed_minutes
+        # Сколько интервалов в истории
+        self.samples = samples
+        # Минут до появления (None - оценки нет)
+        self.low = low
+        self.median = median
+        self.high = high
+        # Вероятность появления в ближайший час
+        self.chance_hour = chance_hour
+
+    @property
+    def overdue(self) -> bool:
+        """Прошло больше любого интервала из истории"""
+        return self.samples >= FORECAST_MIN_GAPS and self.median is None
+
+
+class AppearanceForecast:
+    def __init__(self, item_ids: List[str] = RARE_ITEM_IDS, max_gap: int = FORECAST_MAX_GAP_MINUTES):
+        self.item_ids = list(item_ids)
+        self.codes = {item_id: code for code, item_id in enumerate(self.item_ids)}
+        self.max_gap = max_gap
+        # предмет x интервал в минутах (последняя корзина - все, что длиннее max_gap)
+        self.histogram = np.zeros((len(self.item_ids), max_gap + 1), dtype=np.int64)
+        self.last_seen: Dict[str, datetime] = {}
+        self.last_stock_at: Optional[datetime] = None
+        self.ready = False
+        # код предмета -> накопленная сумма гистограммы, сбрасывается при обновлении
+        self._cdf: Dict[int, np.ndarray] = {}
+        # Стоки, пришедшие во время построения по истории: учитываются после него
+        self._pending: List[dict] = []
+        self._lock = asyncio.Lock()
+
+    def __contains__(self, item_id: str) -> bool:
+        return item_id in self.codes
+
+    async def start(self, stocks: AsyncIOMotorCollection, archive: AsyncIOMotorCollection):
+        """Построить модель по истории в фоне (до готовности прогноз не выдается)"""
+        asyncio.create_task(self._initial_rebuild(stocks, archive))
+
+    async def _initial_rebuild(self, stocks: AsyncIOMotorCollection, archive: AsyncIOMotorCollection):
+        try:
+            await self.rebuild(stocks, archive)
+        except Exception as e:
+            logger.error(f"❌ Ошибка построения прогноза появлений: {e}")
+
+    async def rebuild(self, stocks: AsyncIOMotorCollection, archive: AsyncIOMotorCollection):
+        async with self._lock:
+            history = await load_history(stocks, archive)
+            self.build(history)
+            logger.info(f"🔮 Прогноз появлений построен по {len(history)} стокам")
+
+    def build(self, history: List[dict]):
+        """Векторный расчет гистограмм интервалов по списку стоков"""
+        codes = []
+        times = []
+        last_stock = None
+        for stock in history:
+            created_at = naive_utc(stock['created_at'])
+            last_stock = created_at if last_stock is None else max(last_stock, created_at)
+            millis = (created_at - EPOCH) // timedelta(milliseconds=1)
+            for key, _, _, _ in stock_items(stock):
+                code = self.codes.get(key)
+                if code is not None:
+                    codes.append(code)
+                    times.append(millis)
+
+        histogram = np.zeros_like(self.histogram)
+        last_seen = {}
+        if codes:
+            codes_array = np.array(codes, dtype=np.int64)
+            times_array = np.array(times, dtype=np.int64)
+            order = np.lexsort((times_array, codes_array))
+            codes_sorted = codes_array[order]
+            times_sorted = times_array[order]
+
+            same_item = codes_sorted[1:] == codes_sorted[:-1]
+            gaps = np.rint(np.diff(times_sorted)[same_item] / 60000.0).astype(np.int64)
+            np.add.at(histogram, (codes_sorted[1:][same_item], np.minimum(gaps, self.max_gap)), 1)
+
+            # Последнее появление - последний элемент группы предмета
+            group_ends = np.flatnonzero(np.append(codes_sorted[1:] != codes_sorted[:-1], True))
+            for end in group_ends.tolist():
+                last_seen[self.item_ids[codes_sorted[end]]] = \
+                    EPOCH + timedelta(milliseconds=int(times_sorted[end]))
+
+        self.histogram = histogram
+        self.last_seen = last_seen
+        self.last_stock_at = last_stock
+        self._cdf = {}
+        self.ready = True
+        pending, self._pending = self._pending, []
+        for stock in sorted(pending, key=lambda stock: naive_utc(stock['created_at'])):
+            self.apply_stock(stock)
+
+    async def record_stock(self, stock: dict):
+        """Учесть новый сток: O(1) на каждый редкий предмет в нем"""
+        async with self._lock:
+            self.apply_stock(stock)
+
+    def apply_stock(self, stock: dict):
+        """Учесть сток без ожидания (для обработчиков change stream)"""
+        if not self.ready:
+            self._pending.append(stock)
+            return
+        created_at = naive_utc(stock['created_at'])
+        # Повтор или сток, уже учтенный построением по истории
+        if self.last_stock_at is not None and created_at <= self.last_stock_at:
+            return
+        self.last_stock_at = created_at
+        for key, _, _, _ in stock_items(stock):
+            code = self.codes.get(key)
+            if code is None:
+                continue
+            previous = self.last_seen.get(key)
+            if previous is not None:
+                gap = round((created_at - previous).total_seconds() / 60)
+                self.histogram[code, min(gap, self.max_gap)] += 1
+                self._cdf.pop(code, None)
+            self.last_seen[key] = created_at
+
+    def _cumulative(self, code: int) -> np.ndarray:
+        cdf = self._cdf.get(code)
+        if cdf is None:
+            cdf = self._cdf[code] = np.cumsum(self.histogram[code])
+        return cdf
+
+    def predict(self, item_id: str, now: Optional[datetime] = None, since: Optional[datetime] = None) -> Optional[Forecast]:
+        """Прогноз для предмета на момент now. None - предмет еще не появлялся.
+
+        since - время появления, от которого считать (по умолчанию последнее учтенное).
+        """
+        last_seen = naive_utc(since) if since is not None else self.last_seen.get(item_id)
+        if not self.ready or last_seen is None:
+            return None
+        now = naive_utc(now) if now is not None else datetime.utcnow()
+        elapsed = max((now - last_seen).total_seconds() / 60, 0.0)
+
+        cdf = self._cumulative(self.codes[item_id])
+        # Интервалы длиннее max_gap неизвестной длины в квантили не входят
+        samples = int(cdf[-1])
+        forecast = Forecast(item_id, last_seen, elapsed, samples)
+        if samples < FORECAST_MIN_GAPS:
+            return forecast
+
+        passed = min(int(elapsed), self.max_gap)
+        known = int(cdf[self.max_gap - 1])
+        survivors = known - int(cdf[passed]) if passed < self.max_gap else 0
+        if survivors <= 0:
+            return forecast
+
+        # Первая минута, на которой условная доля интервалов достигает квантиля
+        targets = cdf[passed] + FORECAST_QUANTILES * survivors
+        minutes = np.searchsorted(cdf[:self.max_gap], targets, side='left')
+        low, median, high = np.maximum(minutes - elapsed, 0.0).tolist()
+        within_hour = int(cdf[min(passed + 60, self.max_gap - 1)]) - int(cdf[passed])
+
+        forecast.low, forecast.median, forecast.high = low, median, high
+        forecast.chance_hour = within_hour / survivors
+        return forecast
+
+    def predict_all(self, now: Optional[datetime] = None) -> List[Forecast]:
+        """Прогнозы по всем редким предметам, от ближайшего появления"""
+        forecasts = [self.predict(item_id, now) for item_id in self.item_ids]
+        forecasts = [forecast for forecast in forecasts if forecast is not None]
+        return sorted(forecasts, key=lambda forecast: (forecast.median is None, forecast.median or 0))
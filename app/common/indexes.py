@@ -0,0 +1,205 @@
+"""Индексы общих коллекций и проверка планов горячих запросов.
+
+Каждый сервис вызывает ``ensure_indexes`` при старте, затем ``audit_queries``
+проверяет через explain, что горячие запросы идут по индексу: без COLLSCAN
+и сортировки в памяти, а покрытые запросы - еще и без FETCH.
+
+Ручная проверка (код выхода 1, если план какого-то запроса деградировал)::
+
+    python -m app.common.indexes
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Падать при старте, если горячий запрос перестал идти по индексу (по умолчанию - только
+# предупреждение; ручная проверка ``python -m app.common.indexes`` строгая всегда)
+INDEX_AUDIT_STRICT = os.getenv('INDEX_AUDIT_STRICT', '0') == '1'
+
+# Имена не задаются: совпадают с индексами, уже созданными create_index в сервисах
+INDEXES: Dict[str, List[IndexModel]] = {
+    'stocks': [
+        # Последние стоки для /current, /history и кэша стоков; _id делает опрос кэша покрытым
+        IndexModel([('created_at', DESCENDING), ('_id', DESCENDING)]),
+    ],
+    'plant_subscriptions': [
+        IndexModel([('user_id', ASCENDING)], unique=True),
+        IndexModel([('items', ASCENDING)]),
+        # Инкрементальный опрос индекса подписок воркера
+        IndexModel([('updated_at', ASCENDING)]),
+    ],
+    'users': [
+        IndexModel([('user_id', ASCENDING)], unique=True),
+        # Прогрев кэша подтвержденных пользователей читается только из индекса
+        IndexModel([('subscription_confirmed', ASCENDING), ('user_id', ASCENDING)]),
+    ],
+}
+
+
+class HotQuery:
+    """Запрос горячего пути, план которого проверяется через explain"""
+
+    def __init__(
+        self,
+        name: str,
+        collection: str,
+        filter: dict,
+        projection: Optional[dict] = None,
+        sort: Optional[list] = None,
+        limit: int = 0,
+        covered: bool = False,
+        index: Optional[list] = None,
+    ):
+        self.name = name
+        self.collection = collection
+        self.filter = filter
+        self.projection = projection
+        self.sort = sort
+        self.limit = limit
+        # Покрытый запрос не должен читать сами документы (стадия FETCH)
+        self.covered = covered
+        # Ключи индекса из INDEXES, на который рассчитан запрос
+        self.index = index
+
+
+STOCKS_BY_TIME = [('created_at', DESCENDING), ('_id', DESCENDING)]
+
+HOT_QUERIES = [
+    HotQuery('recent_stocks', 'stocks', {}, sort=[('created_at', DESCENDING)], limit=6, index=STOCKS_BY_TIME),
+    HotQuery('newest_stock_id', 'stocks', {}, {'_id': 1}, sort=[('created_at', DESCENDING)], limit=1, covered=True,
+             index=STOCKS_BY_TIME),
+    # Страница истории по keyset-курсору (created_at, _id)
+    HotQuery('history_page', 'stocks', {'$or': [
+        {'created_at': {'$lt': datetime(2025, 1, 1)}},
+        {'created_at': datetime(2025, 1, 1), '_id': {'$lt': ObjectId('000000000000000000000000')}},
+    ]}, sort=STOCKS_BY_TIME, limit=7, index=STOCKS_BY_TIME),
+    HotQuery('user_subscription', 'plant_subscriptions', {'user_id': 0}, {'items': 1}, limit=1,
+             index=[('user_id', ASCENDING)]),
+    HotQuery('changed_subscriptions', 'plant_subscriptions', {'updated_at': {'$gt': datetime(2025, 1, 1)}},
+             {'user_id': 1, 'items': 1, 'items_mask': 1, 'updated_at': 1}, index=[('updated_at', ASCENDING)]),
+    HotQuery('user_confirmation', 'users', {'user_id': 0}, {'subscription_confirmed': 1}, limit=1,
+             index=[('user_id', ASCENDING)]),
+    HotQuery('confirmed_users', 'users', {'subscription_confirmed': True}, {'user_id': 1, '_id': 0}, covered=True,
+             index=[('subscription_confirmed', ASCENDING), ('user_id', ASCENDING)]),
+]
+
+# (коллекция, ключи индекса)
+IndexRef = Tuple[str, Tuple[Tuple[str, int], ...]]
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase) -> Set[IndexRef]:
+    """Создать недостающие индексы (существующие с теми же ключами не пересоздаются).
+
+    Возвращает индексы, которые создать не удалось.
+    """
+    failed = set()
+    for collection_name, indexes in INDEXES.items():
+        for index in indexes:
+            # По одному: ошибка одного индекса не мешает создать остальные
+            try:
+                await db[collection_name].create_indexes([index])
+            except OperationFailure as e:
+                # Например, дубли user_id мешают уникальному индексу - сервис должен запуститься
+                logger.error(f"❌ Не удалось создать индекс {index.document['key']} в {collection_name}: {e}")
+                failed.add((collection_name, tuple(index.document['key'].items())))
+    logger.info("✅ Индексы коллекций проверены")
+    return failed
+
+
+def plan_stages(plan) -> Set[str]:
+    """Все стадии плана explain (формат классического движка и SBE)"""
+    stages = set()
+    if isinstance(plan, dict):
+        stage = plan.get('stage')
+        if stage:
+            stages.add(stage)
+        for value in plan.values():
+            stages |= plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            stages |= plan_stages(value)
+    return stages
+
+
+def plan_problems(query: HotQuery, stages: Set[str]) -> List[str]:
+    problems = []
+    if 'COLLSCAN' in stages:
+        problems.append("полный просмотр коллекции")
+    if 'SORT' in stages:
+        problems.append("сортировка в памяти")
+    if query.covered and 'FETCH' in stages:
+        problems.append("чтение документов вместо покрытого индексом запроса")
+    return problems
+
+
+async def explain_query(db: AsyncIOMotorDatabase, query: HotQuery) -> dict:
+    cursor = db[query.collection].find(query.filter, query.projection)
+    if query.sort:
+        cursor = cursor.sort(query.sort)
+    if query.limit:
+        cursor = cursor.limit(query.limit)
+    return await cursor.explain()
+
+
+def missing_index(query: HotQuery, failed: Iterable[IndexRef]) -> bool:
+    return query.index is not None and (query.collection, tuple(query.index)) in set(failed)
+
+
+async def audit_queries(
+    db: AsyncIOMotorDatabase,
+    queries: List[HotQuery] = HOT_QUERIES,
+    failed: Iterable[IndexRef] = (),
+) -> Dict[str, List[str]]:
+    """Проверить планы горячих запросов. Возвращает {имя запроса: проблемы}.
+
+    Запросы, чей индекс не создался, не проверяются: ошибка уже залогирована
+    ensure_indexes, а полный просмотр для них ожидаем.
+    """
+    report = {}
+    failed = set(failed)
+    for query in queries:
+        if missing_index(query, failed):
+            logger.warning(f"⚠️ Запрос {query.name} ({query.collection}) не проверяется: его индекс не создан")
+            continue
+        explain = await explain_query(db, query)
+        winning_plan = explain.get('queryPlanner', {}).get('winningPlan', {})
+        problems = plan_problems(query, plan_stages(winning_plan))
+        if problems:
+            report[query.name] = problems
+            logger.warning(f"⚠️ Запрос {query.name} ({query.collection}) не идет по индексу: {', '.join(problems)}")
+    return report
+
+
+async def bootstrap_indexes(db: AsyncIOMotorDatabase, strict: bool = INDEX_AUDIT_STRICT):
+    """Создать индексы и проверить планы горячих запросов при старте сервиса"""
+    failed = await ensure_indexes(db)
+    report = await audit_queries(db, failed=failed)
+    if report and strict:
+        raise RuntimeError(f"Горячие запросы не идут по индексу: {report}")
+
+
+async def check():
+    from mongo_init import get_db
+
+    db = get_db()
+    failed = await ensure_indexes(db)
+    report = await audit_queries(db, failed=failed)
+    for query in HOT_QUERIES:
+        if missing_index(query, failed):
+            report[query.name] = ["индекс не создан"]
+        problems = report.get(query.name)
+        print(f"{'❌' if problems else '✅'} {query.name}: {', '.join(problems) if problems else 'по индексу'}")
+    return not report
+
+
+if __name__ == '__main__':
+    raise SystemExit(0 if asyncio.run(check()) else 1)
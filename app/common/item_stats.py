@@ -0,0 +1,265 @@
+"""Статистика появлений предметов в стоке.
+
+Воркер обновляет счетчики при каждом новом стоке (O(число предметов в
+стоке)), бот читает готовые документы коллекции item_stats. Полная
+пересборка по истории (горячие стоки и дневные бакеты архива) считается
+векторно в NumPy::
+
+    python -m app.common.item_stats
+"""
+import asyncio
+import bisect
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ReplaceOne, UpdateOne
+
+from app.common.items import AVAILABLE_ITEMS, item_key
+
+logger = logging.getLogger(__name__)
+
+# Верхние границы корзин распределения интервалов между появлениями, в минутах
+GAP_BUCKETS_MINUTES = (5, 10, 15, 30, 60, 120, 240, 480, 1440, 2880, 10080)
+GAP_BUCKET_LABELS = tuple(f'le_{edge}' for edge in GAP_BUCKETS_MINUTES) + ('inf',)
+
+# Документ с общими счетчиками по всем стокам
+META_ID = '__meta__'
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def gap_bucket(gap_minutes: float) -> str:
+    """Корзина интервала: первая граница, не меньшая интервала"""
+    return GAP_BUCKET_LABELS[bisect.bisect_left(GAP_BUCKETS_MINUTES, gap_minutes)]
+
+
+def format_minutes(minutes: float) -> str:
+    """Длительность для сообщений: минуты, часы или дни"""
+    if minutes < 60:
+        return f"{minutes:.0f} мин"
+    if minutes < 1440:
+        return f"{minutes / 60:.1f} ч"
+    return f"{minutes / 1440:.1f} д"
+
+
+def naive_utc(moment: datetime) -> datetime:
+    """MongoDB хранит UTC без часового пояса, discord отдает aware-время"""
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def stock_items(stock: dict) -> Iterable[Tuple[str, str, str, int]]:
+    """(ключ, тип, название, количество) для каждого предмета стока"""
+    for item_type, field in (('seed', 'seeds_stock'), ('gear', 'gear_stock')):
+        for name, quantity in (stock.get(field) or {}).items():
+            yield item_key(name, item_type), item_type, name, int(quantity or 0)
+
+
+def item_name(key: str, fallback: str) -> str:
+    item_info = AVAILABLE_ITEMS.get(key)
+    return item_info['name'] if item_info else fallback
+
+
+class ItemStats:
+    """Счетчики появлений предметов в коллекции item_stats.
+
+    Документ предмета: appearances, quantity_total, first_seen, last_seen,
+    gap_count, gap_sum_minutes и gaps - распределение интервалов между
+    соседними появлениями по корзинам GAP_BUCKET_LABELS.
+    """
+
+    def __init__(self, collection: AsyncIOMotorCollection):
+        self.collection = collection
+        # ключ предмета -> last_seen: интервал считается без чтения базы
+        self.last_seen: Dict[str, datetime] = {}
+        self.last_stock_at: Optional[datetime] = None
+        self._lock = asyncio.Lock()
+
+    async def load(self) -> bool:
+        """Загрузить last_seen предметов. False - статистика еще не собиралась."""
+        meta = None
+        last_seen = {}
+        async for doc in self.collection.find({}, {'last_seen': 1, 'last_stock_at': 1}):
+            if doc['_id'] == META_ID:
+                meta = doc
+            elif doc.get('last_seen'):
+                last_seen[doc['_id']] = doc['last_seen']
+        self.last_seen = last_seen
+        self.last_stock_at = meta.get('last_stock_at') if meta else None
+        return meta is not None
+
+    async def start(self, stocks: AsyncIOMotorCollection, archive: AsyncIOMotorCollection):
+        """Загрузить состояние, а при пустой статистике - пересобрать ее по истории"""
+        if not await self.load():
+            asyncio.create_task(self._initial_rebuild(stocks, archive))
+
+    async def _initial_rebuild(self, stocks: AsyncIOMotorCollection, archive: AsyncIOMotorCollection):
+        try:
+            await self.rebuild(stocks, archive)
+        except Exception as e:
+            logger.error(f"❌ Ошибка пересборки статистики предметов: {e}")
+
+    async def record_stock(self, stock: dict):
+        """Учесть новый сток одним bulk_write"""
+        created_at = naive_utc(stock['created_at'])
+        async with self._lock:
+            # Повтор или сток старше уже учтенных (пересборка успела его посчитать)
+            if self.last_stock_at is not None and created_at <= self.last_stock_at:
+                return
+            operations = []
+            for key, item_type, name, quantity in stock_items(stock):
+                update = {
+                    '$inc': {'appearances': 1, 'quantity_total': quantity},
+                    '$set': {'last_seen': created_at, 'name': item_name(key, name), 'type': item_type},
+                    '$min': {'first_seen': created_at},
+                }
+                previous = self.last_seen.get(key)
+                if previous is not None:
+                    gap_minutes = (created_at - previous).total_seconds() / 60
+                    update['$inc'].update({
+                        'gap_count': 1,
+                        'gap_sum_minutes': gap_minutes,
+                        f'gaps.{gap_bucket(gap_minutes)}': 1,
+                    })
+                operations.append(UpdateOne({'_id': key}, update, upsert=True))
+                self.last_seen[key] = created_at
+            operations.append(UpdateOne(
+                {'_id': META_ID},
+                {'$inc': {'stocks_total': 1}, '$set': {'last_stock_at': created_at}, '$min': {'first_stock_at': created_at}},
+                upsert=True
+            ))
+            self.last_stock_at = created_at
+            await self.collection.bulk_write(operations, ordered=False)
+
+    async def rebuild(self, stocks: AsyncIOMotorCollection, archive: AsyncIOMotorCollection) -> int:
+        """Пересчитать статистику по всей истории. Возвращает число учтенных стоков."""
+        async with self._lock:
+            history = await load_history(stocks, archive)
+            documents = compute_item_stats(history)
+            operations = [ReplaceOne({'_id': doc['_id']}, doc, upsert=True) for doc in documents]
+            if operations:
+                await self.collection.bulk_write(operations, ordered=False)
+            # Предметы, которых больше нет в истории (например, после TTL архива)
+            await self.collection.delete_many({'_id': {'$nin': [doc['_id'] for doc in documents]}})
+            await self.load()
+            logger.info(f"📈 Статистика предметов пересобрана по {len(history)} стокам")
+            return len(history)
+
+    async def get_all(self) -> Tuple[Optional[dict], List[dict]]:
+        """Общие счетчики и документы всех предметов"""
+        meta = None
+        items = []
+        async for doc in self.collection.find({}):
+            if doc['_id'] == META_ID:
+                meta = doc
+            else:
+                items.append(doc)
+        return meta, items
+
+
+async def load_history(stocks: AsyncIOMotorCollection, archive: AsyncIOMotorCollection) -> List[dict]:
+    """Все стоки: из дневных бакетов архива и горячей коллекции (без повторов)"""
+    history = {}
+    projection = {'created_at': 1, 'seeds_stock': 1, 'gear_stock': 1}
+    async for bucket in archive.find({}, {'stocks': 1}, batch_size=100):
+        for stock in bucket.get('stocks', []):
+            history[stock['_id']] = stock
+    async for stock in stocks.find({}, projection, batch_size=5000):
+        history[stock['_id']] = stock
+    return list(history.values())
+
+
+def compute_item_stats(history: List[dict]) -> List[dict]:
+    """Векторный расчет документов item_stats по списку стоков"""
+    if not history:
+        return []
+
+    keys: List[str] = []
+    key_codes: Dict[str, int] = {}
+    key_info: Dict[str, Tuple[str, str]] = {}
+    codes = []
+    times = []
+    quantities = []
+    stock_times = []
+    for stock in history:
+        created_at = naive_utc(stock['created_at'])
+        millis = (created_at - EPOCH) // timedelta(milliseconds=1)
+        stock_times.append(millis)
+        for key, item_type, name, quantity in stock_items(stock):
+            code = key_codes.get(key)
+            if code is None:
+                code = key_codes[key] = len(keys)
+                keys.append(key)
+                key_info[key] = (item_type, item_name(key, name))
+            codes.append(code)
+            times.append(millis)
+            quantities.append(quantity)
+
+    documents = []
+    if codes:
+        count = len(keys)
+        codes_array = np.array(codes, dtype=np.int64)
+        times_array = np.array(times, dtype=np.int64)
+        quantities_array = np.array(quantities, dtype=np.float64)
+
+        # Появления каждого предмета подряд и по времени
+        order = np.lexsort((times_array, codes_array))
+        codes_sorted = codes_array[order]
+        times_sorted = times_array[order]
+
+        appearances = np.bincount(codes_array, minlength=count)
+        quantity_total = np.bincount(codes_array, weights=quantities_array, minlength=count)
+        starts = np.searchsorted(codes_sorted, np.arange(count), side='left')
+        ends = np.searchsorted(codes_sorted, np.arange(count), side='right') - 1
+        first_seen = times_sorted[starts]
+        last_seen = times_sorted[ends]
+
+        # Интервалы только между соседними появлениями одного предмета
+        same_item = codes_sorted[1:] == codes_sorted[:-1]
+        gap_codes = codes_sorted[1:][same_item]
+        gap_minutes = np.diff(times_sorted)[same_item] / 60000.0
+        gap_count = np.bincount(gap_codes, minlength=count)
+        gap_sum = np.bincount(gap_codes, weights=gap_minutes, minlength=count)
+        gap_buckets = np.searchsorted(np.array(GAP_BUCKETS_MINUTES, dtype=np.float64), gap_minutes, side='left')
+        histogram = np.zeros((count, len(GAP_BUCKET_LABELS)), dtype=np.int64)
+        np.add.at(histogram, (gap_codes, gap_buckets), 1)
+
+        for code, key in enumerate(keys):
+            item_type, name = key_info[key]
+            gaps = {label: int(value) for label, value in zip(GAP_BUCKET_LABELS, histogram[code]) if value}
+            documents.append({
+                '_id': key,
+                'name': name,
+                'type': item_type,
+                'appearances': int(appearances[code]),
+                'quantity_total': int(quantity_total[code]),
+                'first_seen': EPOCH + timedelta(milliseconds=int(first_seen[code])),
+                'last_seen': EPOCH + timedelta(milliseconds=int(last_seen[code])),
+                'gap_count': int(gap_count[code]),
+                'gap_sum_minutes': float(gap_sum[code]),
+                'gaps': gaps,
+            })
+
+    stock_times_array = np.array(stock_times, dtype=np.int64)
+    documents.append({
+        '_id': META_ID,
+        'stocks_total': len(history),
+        'first_stock_at': EPOCH + timedelta(milliseconds=int(stock_times_array.min())),
+        'last_stock_at': EPOCH + timedelta(milliseconds=int(stock_times_array.max())),
+    })
+    return documents
+
+
+async def main():
+    from mongo_init import get_db
+
+    db = get_db()
+    await ItemStats(db.item_stats).rebuild(db.stocks, db.stock_archive)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,114 @@
+from typing import Dict, Iterable, List, Optional
+
+# Список доступных предметов для подписки (seeds и gear)
+AVAILABLE_ITEMS = {
+    # Seeds
+    'cactus_seed': {'emoji': '🌵', 'name': 'Cactus seed', 'type': 'seed', 'rarity': 'Rare'},
+    'strawberry_seed': {'emoji': '🍓', 'name': 'Strawberry seed', 'type': 'seed', 'rarity': 'Rare'},
+    'pumpkin_seed': {'emoji': '🎃', 'name': 'Pumpkin seed', 'type': 'seed', 'rarity': 'Epic'},
+    'sunflower_seed': {'emoji': '🌻', 'name': 'Sunflower seed', 'type': 'seed', 'rarity': 'Epic'},
+    'dragon_fruit_seed': {'emoji': '🐉', 'name': 'Dragon fruit seed', 'type': 'seed', 'rarity': 'Legendary'},
+    'eggplant_seed': {'emoji': '🍆', 'name': 'Eggplant seed', 'type': 'seed', 'rarity': 'Legendary'},
+    'watermelon_seed': {'emoji': '🍉', 'name': 'Watermelon seed', 'type': 'seed', 'rarity': 'Mythic'},
+    'grape_seed': {'emoji': '🍇', 'name': 'Grape seed', 'type': 'seed', 'rarity': 'Mythic'},
+    'cocotank_seed': {'emoji': '🥥', 'name': 'Cocotank seed', 'type': 'seed', 'rarity': 'Godly'},
+    'carnivorous_plant_seed': {'emoji': '🌿', 'name': 'Carnivorous plant seed', 'type': 'seed', 'rarity': 'Godly'},
+    'mr_carrot_seed': {'emoji': '🥕', 'name': 'Mr Carrot seed', 'type': 'seed', 'rarity': 'Secret'},
+    'tomatrio_seed': {'emoji': '🍅', 'name': 'Tomatrio seed', 'type': 'seed', 'rarity': 'Secret'},
+    'shroombino_seed': {'emoji': '🍄', 'name': 'Shroombino seed', 'type': 'seed', 'rarity': 'Secret'},
+    'mango_seed': {'emoji': '🥭', 'name': 'Mango seed', 'type': 'seed', 'rarity': 'Secret'},
+    'king_limon_seed': {'emoji': '🍋', 'name': 'King Limon seed', 'type': 'seed', 'rarity': 'Secret'},
+    'starfruit_seed': {'emoji': '🌟', 'name': 'Starfruit seed', 'type': 'seed', 'rarity': 'Secret'},
+    # Gear
+    'water_bucket': {'emoji': '🪣', 'name': 'Water Bucket', 'type': 'gear', 'rarity': 'Epic'},
+    'frost_grenade': {'emoji': '❄️', 'name': 'Frost Grenade', 'type': 'gear', 'rarity': 'Epic'},
+    'banana_gun': {'emoji': '🍌', 'name': 'Banana Gun', 'type': 'gear', 'rarity': 'Epic'},
+    'frost_blower': {'emoji': '🌬️', 'name': 'Frost Blower', 'type': 'gear', 'rarity': 'Legendary'},
+    'carrot_launcher': {'emoji': '🥕', 'name': 'Carrot Launcher', 'type': 'gear', 'rarity': 'Godly'}
+}
+
+# Бит предмета в маске подписок. Позиции хранятся в базе, поэтому
+# новые предметы добавляются только в конец, а удаленные не переиспользуются.
+ITEM_BITS = {item_id: 1 << position for position, item_id in enumerate(AVAILABLE_ITEMS)}
+
+
+def items_to_mask(items: Iterable[str]) -> int:
+    """Список id предметов -> битовая маска (неизвестные id игнорируются)"""
+    mask = 0
+    for item_id in items:
+        mask |= ITEM_BITS.get(item_id, 0)
+    return mask
+
+
+def mask_to_items(mask: int) -> List[str]:
+    """Битовая маска -> список id предметов в порядке каталога"""
+    return [item_id for item_id, bit in ITEM_BITS.items() if mask & bit]
+
+
+def normalize_item_name(name: str) -> str:
+    """'Mr Carrot Seed' -> 'mr_carrot_seed'"""
+    return '_'.join(name.lower().split())
+
+
+class ItemResolver:
+    """Поиск предмета каталога по названию из стока за O(1).
+
+    Таблица строится один раз и покрывает id предмета, его название,
+    вариант с суффиксом '_seed' и без него, а также написание без подчеркиваний.
+    """
+
+    def __init__(self, items: Dict[str, dict]):
+        self.items = items
+        self._tables: Dict[Optional[str], Dict[str, str]] = {None: {}}
+        self._cache: Dict[tuple, Optional[str]] = {}
+        self.hits = 0
+        self.misses = 0
+
+        for item_id, item_info in items.items():
+            table = self._tables.setdefault(item_info['type'], {})
+            keys = {item_id, normalize_item_name(item_info['name'])}
+            if item_info['type'] == 'seed':
+                keys |= {key[:-len('_seed')] for key in keys if key.endswith('_seed')}
+            keys |= {key.replace('_', '') for key in keys}
+            for key in keys:
+                table.setdefault(key, item_id)
+                self._tables[None].setdefault(key, item_id)
+
+    def resolve(self, name: str, item_type: Optional[str] = None) -> Optional[str]:
+        """id предмета по названию из стока или None"""
+        cache_key = (name, item_type)
+        if cache_key in self._cache:
+            self.hits += 1
+            return self._cache[cache_key]
+        self.misses += 1
+
+        table = self._tables.get(item_type, {})
+        key = normalize_item_name(name)
+        item_id = table.get(key)
+        if item_id is None:
+            item_id = table.get(key.replace('_', ''))
+
+        self._cache[cache_key] = item_id
+        return item_id
+
+    def get(self, name: str, item_type: Optional[str] = None) -> Optional[dict]:
+        """Описание предмета (emoji, rarity...) по названию из стока"""
+        item_id = self.resolve(name, item_type)
+        return self.items[item_id] if item_id else None
+
+    def emoji(self, name: str, item_type: Optional[str] = None) -> str:
+        item_info = self.get(name, item_type)
+        return item_info['emoji'] if item_info else ''
+
+
+# Общий резолвер для каталога по умолчанию
+item_resolver = ItemResolver(AVAILABLE_ITEMS)
+
+
+def item_key(name: str, item_type: str) -> str:
+    """Ключ предмета для хранения (архив, статистика): id каталога или нормализованное название"""
+    item_id = item_resolver.resolve(name, item_type)
+    if item_id:
+        return item_id
+    # Точки и $ недопустимы в путях полей MongoDB
+    return normalize_item_name(name).replace('.', '_').replace('$', '_')
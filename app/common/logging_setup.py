@@ -0,0 +1,77 @@
+"""Асинхронное логирование для воркеров и бота.
+
+Обработчики событий кладут записи в очередь (QueueHandler), а в stdout
+и файл их пишет отдельный поток QueueListener - рассылка не ждет
+системных вызовов записи. Отладочные строки по отдельным пользователям
+прореживаются: проходит одна из LOG_SAMPLE_RATE.
+"""
+import atexit
+import itertools
+import logging
+import logging.handlers
+import os
+import queue
+from typing import Optional
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_DIR = os.getenv('LOG_DIR', '/app/logs')
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Из скольких отладочных записей с пометкой sampled пропускать одну
+LOG_SAMPLE_RATE = int(os.getenv('LOG_SAMPLE_RATE', '100'))
+
+# Передается в extra у записей, которые пишутся для каждого пользователя рассылки
+SAMPLED = {'sampled': True}
+
+# Библиотеки, которые пишут INFO на каждый HTTP-запрос
+NOISY_LOGGERS = ('httpx', 'httpcore', 'apscheduler', 'uvicorn.access')
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает каждую N-ю запись с extra={'sampled': True}, остальные - без изменений"""
+
+    def __init__(self, rate: int = LOG_SAMPLE_RATE):
+        super().__init__()
+        self.rate = max(1, rate)
+        self._counter = itertools.count()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, 'sampled', False) or record.levelno > logging.DEBUG:
+            return True
+        return next(self._counter) % self.rate == 0
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging(service: str, level: str = LOG_LEVEL, log_dir: Optional[str] = LOG_DIR) -> logging.handlers.QueueListener:
+    """Настроить корневой логгер сервиса: очередь в памяти и фоновая запись в stdout и файл"""
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if log_dir:
+        try:
+            os.makedirs(log_dir, exist_ok=True)
+            handlers.append(logging.FileHandler(os.path.join(log_dir, f'{service}.log'), encoding='utf-8'))
+        except OSError as e:
+            print(f"Warning: Cannot create log file: {e}. Using console output only.")
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # Прореживаем до постановки в очередь, чтобы не тратить на лишние записи даже форматирование
+    queue_handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+    for name in NOISY_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
@@ -0,0 +1,213 @@
+"""Метрики сервисов в текстовом формате Prometheus.
+
+Каждый сервис поднимает внутри своего event loop небольшой HTTP-сервер
+(FastAPI + uvicorn) с эндпоинтом ``/metrics`` на порту METRICS_PORT.
+"""
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Порт эндпоинта /metrics (0 - не запускать)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
+METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0')
+
+# Бакеты по умолчанию в секундах: от запросов к базе до доставки всей рассылки
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+# Разбор embed занимает микросекунды
+PARSE_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05)
+
+LabelValues = Tuple[str, ...]
+
+
+def format_labels(names: Tuple[str, ...], values: LabelValues, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    type_name = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, object]) -> LabelValues:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """Монотонно растущий счетчик"""
+
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value: float, **labels):
+        """Выставить значение из внешнего счетчика (например, hits кэша)"""
+        self._values[self._key(labels)] = value
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{format_labels(self.labelnames, key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    """Текущее значение (размер очереди, число пользователей)"""
+
+    type_name = 'gauge'
+
+
+class Histogram(Metric):
+    """Гистограмма с накопительными бакетами"""
+
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # метки -> [счетчики по бакетам..., сумма, количество]
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[position] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Замер длительности блока: ``with STOCK_INSERT_SECONDS.time(): ...``"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, state in self._values.items():
+            bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+            counts = state[:len(self.buckets)] + [state[-1]]
+            for bound, count in zip(bounds, counts):
+                labels = format_labels(self.labelnames, key, 'le="' + bound + '"')
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {state[-2]}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {state[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        # Вызываются перед выдачей метрик, чтобы снять значения с внешних объектов
+        self.collectors: List[Callable[[], None]] = []
+
+    def _register(self, metric: Metric) -> Metric:
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], None]):
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            collector()
+        return '\n'.join(metric.render() for metric in self.metrics.values()) + '\n'
+
+
+registry = MetricsRegistry()
+
+# Общие метрики горячего пути
+STOCK_PARSE_SECONDS = registry.histogram(
+    'stock_parse_seconds', "Время разбора стока", ['source'], buckets=PARSE_BUCKETS
+)
+STOCK_INSERT_SECONDS = registry.histogram('stock_insert_seconds', "Время записи стока в MongoDB", ['source'])
+NOTIFICATION_FIRST_SECONDS = registry.histogram(
+    'notification_first_seconds', "От получения стока до первого доставленного уведомления", ['source']
+)
+NOTIFICATION_LAST_SECONDS = registry.histogram(
+    'notification_last_seconds', "От получения стока до последнего доставленного уведомления", ['source']
+)
+RARE_ALERT_SECONDS = registry.histogram('rare_alert_seconds', "От получения стока до поста о редких предметах в канале")
+TELEGRAM_SENDS = registry.counter('telegram_sends_total', "Успешные отправки в Telegram")
+TELEGRAM_RETRIES = registry.counter('telegram_retries_total', "Повторы отправки после RetryAfter")
+TELEGRAM_SEND_ERRORS = registry.counter('telegram_send_errors_total', "Ошибки отправки по типу исключения", ['error'])
+CACHE_REQUESTS = registry.counter('cache_requests_total', "Обращения к кэшам", ['cache', 'result'])
+
+
+def register_cache(name: str, cache):
+    """Отдавать hits/misses кэша (атрибуты объекта) в cache_requests_total"""
+    def collect():
+        CACHE_REQUESTS.set(cache.hits, cache=name, result='hit')
+        CACHE_REQUESTS.set(cache.misses, cache=name, result='miss')
+    registry.add_collector(collect)
+
+
+def create_app():
+    from fastapi import FastAPI
+    from fastapi.responses import PlainTextResponse
+
+    app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+
+    @app.get('/metrics', response_class=PlainTextResponse)
+    async def metrics():
+        return PlainTextResponse(registry.render(), media_type='text/plain; version=0.0.4')
+
+    return app
+
+
+async def start_metrics_server(port: int = METRICS_PORT, host: str = METRICS_HOST) -> Optional[asyncio.Task]:
+    """Запустить эндпоинт /metrics в текущем event loop"""
+    if not port:
+        return None
+    import uvicorn
+
+    class EmbeddedServer(uvicorn.Server):
+        # Сигналами управляет сам сервис (discord.py, PTB), uvicorn их не перехватывает
+        @contextlib.contextmanager
+        def capture_signals(self):
+            yield
+
+    config = uvicorn.Config(create_app(), host=host, port=port, log_level='warning', access_log=False)
+    server = EmbeddedServer(config)
+    task = asyncio.create_task(server.serve())
+    logger.info(f"📈 Метрики доступны на http://{host}:{port}/metrics")
+    return task
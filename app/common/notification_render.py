@@ -0,0 +1,44 @@
+from typing import Dict, Hashable, Iterable, Optional
+
+
+class StockNotificationRenderer:
+    """Рендер персональных уведомлений для одного стока.
+
+    Шапка, строки предметов и хвост (например, весь сток) строятся один раз
+    на сток. Пользователи с одинаковым набором совпавших предметов получают
+    один и тот же объект строки.
+    """
+
+    def __init__(self, prefix: str, item_lines: Dict[Hashable, str], suffix: str, joiner: str = "\n"):
+        self.prefix = prefix
+        self.item_lines = item_lines
+        self.suffix = suffix
+        self.joiner = joiner
+        self._messages: Dict[Hashable, str] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        """Сколько уникальных сообщений отрендерено"""
+        return len(self._messages)
+
+    def render(self, matched: Iterable[Hashable], cache_key: Optional[Hashable] = None) -> str:
+        """Сообщение для набора совпавших предметов.
+
+        cache_key позволяет не собирать набор на попадании в кэш
+        (например, битовая маска вместо множества id).
+        """
+        if cache_key is None:
+            matched = frozenset(matched)
+            cache_key = matched
+        message = self._messages.get(cache_key)
+        if message is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            matched = set(matched)
+            # Строки идут в порядке стока, а не в порядке подписок
+            lines = [line for key, line in self.item_lines.items() if key in matched]
+            message = self.prefix + self.joiner.join(lines) + self.suffix
+            self._messages[cache_key] = message
+        return message
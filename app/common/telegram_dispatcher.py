@@ -0,0 +1,247 @@
+import asyncio
+import heapq
+import itertools
+import os
+from collections import Counter
+from datetime import timedelta
+from typing import Dict, List, Optional, Union
+
+from telegram import Bot, Message
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+from app.common.metrics import TELEGRAM_RETRIES, TELEGRAM_SEND_ERRORS, TELEGRAM_SENDS
+
+# Глобальный лимит Telegram: ~30 сообщений в секунду
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+TELEGRAM_GLOBAL_BURST = float(os.getenv('TELEGRAM_GLOBAL_BURST', '30'))
+# Лимит на один чат: 1 сообщение в секунду для личных чатов, 20 в минуту для групп и каналов
+TELEGRAM_PRIVATE_CHAT_INTERVAL = float(os.getenv('TELEGRAM_PRIVATE_CHAT_INTERVAL', '1'))
+TELEGRAM_GROUP_CHAT_INTERVAL = float(os.getenv('TELEGRAM_GROUP_CHAT_INTERVAL', '3'))
+# Сколько раз повторять отправку после RetryAfter
+TELEGRAM_MAX_RETRIES = int(os.getenv('TELEGRAM_MAX_RETRIES', '5'))
+# Полосы отправки в порядке приоритета: пост в канал, массовая рассылка
+LANE_CHANNEL = 'channel'
+LANE_BULK = 'bulk'
+LANE_PRIORITIES = {LANE_CHANNEL: 0, LANE_BULK: 1}
+# Сколько соединений пула HTTPXRequest может занять каждая полоса (в сумме - не больше пула)
+TELEGRAM_LANE_CONNECTIONS = {
+    LANE_CHANNEL: int(os.getenv('TELEGRAM_CHANNEL_CONNECTIONS', '4')),
+    LANE_BULK: int(os.getenv('TELEGRAM_BULK_CONNECTIONS', '80')),
+}
+
+ChatId = Union[int, str]
+
+# Классы ошибок отправки
+ERROR_DEAD_CHAT = 'dead_chat'   # Пользователь заблокировал бота, удален или чат не существует
+ERROR_RETRYABLE = 'retryable'   # Временная ошибка: flood control, сеть
+ERROR_PERMANENT = 'permanent'   # Ошибка конкретного сообщения, повтор не поможет
+
+# BadRequest, после которых писать в чат бессмысленно
+DEAD_CHAT_BAD_REQUESTS = ('chat not found', 'user not found', 'peer_id_invalid', 'user is deactivated')
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Пауза из RetryAfter в секундах (int или timedelta в зависимости от версии PTB)"""
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+def classify_error(error: Exception) -> str:
+    """Класс ошибки отправки по типу исключения Telegram"""
+    if isinstance(error, Forbidden):
+        return ERROR_DEAD_CHAT
+    if isinstance(error, BadRequest):
+        message = str(error).lower()
+        if any(reason in message for reason in DEAD_CHAT_BAD_REQUESTS):
+            return ERROR_DEAD_CHAT
+        return ERROR_PERMANENT
+    if isinstance(error, (RetryAfter, NetworkError)):
+        return ERROR_RETRYABLE
+    if isinstance(error, TelegramError):
+        return ERROR_PERMANENT
+    return ERROR_RETRYABLE
+
+
+class TokenBucket:
+    """Token bucket: ограничивает пропускную способность, а не конкурентность.
+
+    Токены выдаются по приоритету ожидающих (меньше - раньше), внутри
+    одного приоритета - в порядке очереди.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at: Optional[float] = None
+        self.paused_until = 0.0
+        # Куча [priority, порядковый номер, future] ожидающих токен
+        self._waiters: List[list] = []
+        self._sequence = itertools.count()
+        self._issuer: Optional[asyncio.Task] = None
+
+    def _refill(self, now: float):
+        if self.updated_at is None:
+            self.updated_at = now
+        self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def pause(self, seconds: float):
+        """Остановить выдачу токенов (flood control от Telegram)"""
+        loop = asyncio.get_running_loop()
+        self.paused_until = max(self.paused_until, loop.time() + seconds)
+        # Токены начинают накапливаться только после окончания паузы
+        self.tokens = 0
+        self.updated_at = self.paused_until
+
+    async def acquire(self, priority: int = 0):
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        heapq.heappush(self._waiters, [priority, next(self._sequence), waiter])
+        if self._issuer is None or self._issuer.done():
+            self._issuer = asyncio.create_task(self._issue())
+        await waiter
+
+    async def _issue(self):
+        """Выдает токены ожидающим, пока очередь не опустеет"""
+        loop = asyncio.get_running_loop()
+        while self._waiters:
+            now = loop.time()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self._refill(now)
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            # Приоритет выбирается в момент выдачи: пришедший позже пост в канал обгонит рассылку
+            _, _, waiter = heapq.heappop(self._waiters)
+            if waiter.done():
+                # Ожидающий отменен
+                continue
+            self.tokens -= 1
+            waiter.set_result(None)
+
+
+class DispatcherStats:
+    """Счетчики доставки"""
+
+    def __init__(self):
+        self.sent = 0
+        self.retried = 0
+        self.errors: Counter = Counter()
+
+    @property
+    def failed(self) -> int:
+        return sum(self.errors.values())
+
+    def record_sent(self):
+        self.sent += 1
+        TELEGRAM_SENDS.inc()
+
+    def record_retry(self):
+        self.retried += 1
+        TELEGRAM_RETRIES.inc()
+
+    def record_error(self, error: Exception):
+        error_type = type(error).__name__
+        self.errors[error_type] += 1
+        TELEGRAM_SEND_ERRORS.inc(error=error_type)
+
+    def snapshot(self) -> dict:
+        return {
+            'sent': self.sent,
+            'retried': self.retried,
+            'failed': self.failed,
+            'errors': dict(self.errors),
+        }
+
+    def reset(self) -> dict:
+        """Вернуть текущие значения и обнулить счетчики"""
+        snapshot = self.snapshot()
+        self.sent = 0
+        self.retried = 0
+        self.errors = Counter()
+        return snapshot
+
+
+class TelegramDispatcher:
+    """Отправка сообщений в Telegram с глобальным и поканальным rate limit.
+
+    При RetryAfter весь диспетчер ставится на паузу на retry_after секунд,
+    после чего сообщение отправляется повторно, а не теряется.
+
+    Отправки идут по полосам (канал, массовая рассылка): у каждой свой
+    лимит соединений, а токены глобального лимита выдаются в порядке
+    приоритета полосы. Пост о редких предметах не ждет ни свободного
+    соединения, ни очереди рассылки.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        rate: float = TELEGRAM_GLOBAL_RATE,
+        burst: float = TELEGRAM_GLOBAL_BURST,
+        lane_connections: Optional[Dict[str, int]] = None,
+        max_retries: int = TELEGRAM_MAX_RETRIES,
+    ):
+        self.bot = bot
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        lane_connections = {**TELEGRAM_LANE_CONNECTIONS, **(lane_connections or {})}
+        self._lanes = {lane: asyncio.Semaphore(connections) for lane, connections in lane_connections.items()}
+        # chat_id -> время (loop.time()), раньше которого нельзя писать в чат
+        self._chat_next: Dict[ChatId, float] = {}
+        self.stats = DispatcherStats()
+
+    @staticmethod
+    def chat_interval(chat_id: ChatId) -> float:
+        # Группы и каналы имеют отрицательный id или @username
+        if isinstance(chat_id, str):
+            if chat_id.startswith('@') or chat_id.startswith('-'):
+                return TELEGRAM_GROUP_CHAT_INTERVAL
+            return TELEGRAM_PRIVATE_CHAT_INTERVAL
+        return TELEGRAM_GROUP_CHAT_INTERVAL if chat_id < 0 else TELEGRAM_PRIVATE_CHAT_INTERVAL
+
+    async def _wait_chat_slot(self, chat_id: ChatId):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        next_at = self._chat_next.get(chat_id, 0.0)
+        slot = max(now, next_at)
+        self._chat_next[chat_id] = slot + self.chat_interval(chat_id)
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        # Не даем словарю расти бесконечно
+        if len(self._chat_next) > 100_000:
+            self._chat_next = {cid: t for cid, t in self._chat_next.items() if t > now}
+
+    async def send_message(self, chat_id: ChatId, text: str, lane: str = LANE_BULK, **kwargs) -> Message:
+        """Отправить сообщение с учетом лимитов.
+
+        Повторяет отправку после RetryAfter, остальные ошибки Telegram пробрасывает.
+        """
+        priority = LANE_PRIORITIES[lane]
+        connections = self._lanes[lane]
+        await self._wait_chat_slot(chat_id)
+        attempt = 0
+        while True:
+            await self.bucket.acquire(priority)
+            try:
+                async with connections:
+                    message = await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                self.stats.record_retry()
+                self.bucket.pause(delay)
+                attempt += 1
+                if attempt > self.max_retries:
+                    self.stats.record_error(e)
+                    raise
+                continue
+            except TelegramError as e:
+                self.stats.record_error(e)
+                raise
+            self.stats.record_sent()
+            return message
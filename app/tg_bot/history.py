@@ -0,0 +1,123 @@
+import os
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional, Tuple
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import DESCENDING, ASCENDING
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from app.common.lru_cache import TTLCache
+
+# Сколько отрендеренных страниц истории держать в памяти
+HISTORY_PAGE_CACHE_SIZE = int(os.getenv('HISTORY_PAGE_CACHE_SIZE', '1024'))
+HISTORY_PAGE_CACHE_TTL = 3600
+
+HISTORY_CALLBACK_PREFIX = 'hist:'
+# Направление листания: более ранние / более поздние стоки
+OLDER = 'o'
+NEWER = 'n'
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def encode_cursor(stock: dict) -> str:
+    """Позиция стока в истории: created_at в миллисекундах и _id (для равных created_at)"""
+    created_at = stock['created_at'].replace(tzinfo=None)
+    millis = (created_at - EPOCH) // timedelta(milliseconds=1)
+    return f"{millis}:{stock['_id']}"
+
+
+def decode_cursor(cursor: str) -> Optional[Tuple[datetime, ObjectId]]:
+    try:
+        millis, stock_id = cursor.split(':')
+        return EPOCH + timedelta(milliseconds=int(millis)), ObjectId(stock_id)
+    except (ValueError, InvalidId):
+        return None
+
+
+class HistoryPage:
+    def __init__(self, text: str, markup: Optional[InlineKeyboardMarkup]):
+        self.text = text
+        self.markup = markup
+
+
+class StockHistoryPager:
+    """Листание истории стоков по keyset-курсорам.
+
+    Страница выбирается условием (created_at, _id) < курсора по индексу
+    (created_at, _id), а не skip: стоимость любой страницы - O(размер страницы).
+    Страница перед курсором не меняется, поэтому готовый текст и клавиатура
+    кэшируются по курсору.
+    """
+
+    def __init__(
+        self,
+        collection: AsyncIOMotorCollection,
+        page_size: int,
+        render: Callable[[List[dict]], str],
+        cache_size: int = HISTORY_PAGE_CACHE_SIZE,
+    ):
+        self.collection = collection
+        self.page_size = page_size
+        # Текст страницы по списку стоков (от новых к старым)
+        self.render = render
+        self.pages = TTLCache(cache_size, HISTORY_PAGE_CACHE_TTL)
+
+    def keyboard(self, stocks: List[dict], has_newer: bool, has_older: bool) -> Optional[InlineKeyboardMarkup]:
+        buttons = []
+        if has_newer:
+            buttons.append(InlineKeyboardButton(
+                "➡️ Позже", callback_data=f"{HISTORY_CALLBACK_PREFIX}{NEWER}:{encode_cursor(stocks[0])}"
+            ))
+        if has_older:
+            buttons.append(InlineKeyboardButton(
+                "⬅️ Раньше", callback_data=f"{HISTORY_CALLBACK_PREFIX}{OLDER}:{encode_cursor(stocks[-1])}"
+            ))
+        # Кнопки идут в хронологическом порядке: более ранние слева
+        return InlineKeyboardMarkup([buttons[::-1]]) if buttons else None
+
+    def first_page_markup(self, stocks: List[dict]) -> Optional[InlineKeyboardMarkup]:
+        """Клавиатура первой страницы (сами стоки берутся из кэша последних стоков)"""
+        return self.keyboard(stocks, has_newer=False, has_older=len(stocks) >= self.page_size)
+
+    async def page(self, data: str) -> Optional[HistoryPage]:
+        """Страница по callback_data кнопки. None - стоков в этом направлении нет."""
+        cached = self.pages.get(data)
+        if cached is not None:
+            return cached
+
+        direction, _, cursor = data[len(HISTORY_CALLBACK_PREFIX):].partition(':')
+        position = decode_cursor(cursor)
+        if position is None or direction not in (OLDER, NEWER):
+            return None
+        created_at, stock_id = position
+
+        operator = '$lt' if direction == OLDER else '$gt'
+        order = DESCENDING if direction == OLDER else ASCENDING
+        query = {'$or': [
+            {'created_at': {operator: created_at}},
+            {'created_at': created_at, '_id': {operator: stock_id}},
+        ]}
+        # Лишний сток показывает, есть ли страница дальше
+        stocks = await self.collection.find(query) \
+            .sort([('created_at', order), ('_id', order)]) \
+            .limit(self.page_size + 1) \
+            .to_list(length=self.page_size + 1)
+        if not stocks:
+            return None
+
+        has_more = len(stocks) > self.page_size
+        stocks = stocks[:self.page_size]
+        if direction == OLDER:
+            has_newer, has_older = True, has_more
+        else:
+            stocks.reverse()
+            has_newer, has_older = has_more, True
+
+        page = HistoryPage(self.render(stocks), self.keyboard(stocks, has_newer, has_older))
+        # Неполная страница у свежего края истории еще пополнится новыми стоками
+        if direction == OLDER or has_more:
+            self.pages.set(data, page)
+        return page
@@ -0,0 +1,66 @@
+from typing import Dict, List
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from app.common.items import ITEM_BITS
+
+# Сколько готовых клавиатур (по маске подписок) держать в памяти
+AUTOSTOCK_MARKUP_CACHE_SIZE = 4096
+
+
+class AutostockKeyboard:
+    """Клавиатура меню автостока, рассчитанная один раз.
+
+    Для каждого предмета заранее созданы обе кнопки (подписан/не подписан),
+    на каждый запрос остается только выбрать их по битовой маске подписок.
+    """
+
+    def __init__(self, items: Dict[str, dict]):
+        self.rows: List[list] = []
+        # Сначала семена, затем снаряжение - по 2 кнопки в ряд
+        for item_type, header in (('seed', "🌱 СЕМЕНА"), ('gear', "⚔️ СНАРЯЖЕНИЕ")):
+            self.rows.append([InlineKeyboardButton(header, callback_data="noop")])
+            row = []
+            for item_id, item_info in items.items():
+                if item_info['type'] != item_type:
+                    continue
+                row.append(self._item_buttons(item_id, item_info))
+                if len(row) == 2:
+                    self.rows.append(row)
+                    row = []
+            if row:
+                self.rows.append(row)
+
+        self.clear_row = [InlineKeyboardButton("🗑️ Отписаться от всех", callback_data="clear_subscriptions")]
+        self._markups: Dict[int, InlineKeyboardMarkup] = {}
+
+    @staticmethod
+    def _item_buttons(item_id: str, item_info: dict) -> tuple:
+        label = f"{item_info['emoji']} {item_info['name']}"
+        # Кнопка несет нужное действие: повторное нажатие не переключает подписку обратно
+        subscribed = InlineKeyboardButton(f"✅ {label}", callback_data=f"unsub_item_{item_id}")
+        unsubscribed = InlineKeyboardButton(f"❌ {label}", callback_data=f"sub_item_{item_id}")
+        return ITEM_BITS[item_id], subscribed, unsubscribed
+
+    def markup(self, mask: int) -> InlineKeyboardMarkup:
+        """Клавиатура для пользователя с заданной маской подписок"""
+        reply_markup = self._markups.get(mask)
+        if reply_markup is not None:
+            return reply_markup
+
+        keyboard = [
+            [
+                cell if isinstance(cell, InlineKeyboardButton) else (cell[1] if mask & cell[0] else cell[2])
+                for cell in row
+            ]
+            for row in self.rows
+        ]
+        # Кнопка очистки всех подписок
+        if mask:
+            keyboard.append(self.clear_row)
+
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        if len(self._markups) >= AUTOSTOCK_MARKUP_CACHE_SIZE:
+            self._markups.clear()
+        self._markups[mask] = reply_markup
+        return reply_markup
@@ -0,0 +1,134 @@
+import os
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from app.common.appearance_forecast import AppearanceForecast, Forecast
+from app.common.item_stats import GAP_BUCKET_LABELS, GAP_BUCKETS_MINUTES, ItemStats, format_minutes
+from app.common.items import AVAILABLE_ITEMS
+from app.common.lru_cache import TTLCache
+
+# Сколько держать отрендеренный ответ /stats: счетчики меняются раз в несколько минут
+STATS_CACHE_TTL = float(os.getenv('STATS_CACHE_TTL', '60'))
+STATS_CACHE_SIZE = 256
+
+MOSCOW_TZ = timezone(timedelta(hours=3))
+
+
+def format_moment(moment: Optional[datetime]) -> str:
+    if moment is None:
+        return "—"
+    return moment.replace(tzinfo=timezone.utc).astimezone(MOSCOW_TZ).strftime('%d.%m %H:%M МСК')
+
+
+def gap_label(label: str) -> str:
+    if label == 'inf':
+        return f"> {format_minutes(GAP_BUCKETS_MINUTES[-1])}"
+    return f"≤ {format_minutes(int(label[len('le_'):]))}"
+
+
+class ItemStatsView:
+    """Ответы /stats и /forecast по готовым счетчикам и модели (история стоков не читается)"""
+
+    # Ключ прогноза в кэше ответов
+    FORECAST_KEY = ('forecast',)
+
+    def __init__(self, item_stats: ItemStats, forecast: AppearanceForecast):
+        self.item_stats = item_stats
+        self.forecast = forecast
+        # item_id, None (сводка) или FORECAST_KEY -> текст ответа
+        self.rendered = TTLCache(STATS_CACHE_SIZE, STATS_CACHE_TTL)
+
+    async def render(self, item_id: Optional[str] = None) -> Optional[str]:
+        """Сводка по всем предметам или подробности по одному. None - статистики еще нет."""
+        text = self.rendered.get(item_id)
+        if text is None:
+            meta, items = await self.item_stats.get_all()
+            if meta is None:
+                return None
+            if item_id is None:
+                text = self.format_summary(meta, items)
+            else:
+                doc = next((doc for doc in items if doc['_id'] == item_id), None)
+                text = self.format_item(meta, item_id, doc)
+            self.rendered.set(item_id, text)
+        return text
+
+    def format_summary(self, meta: dict, items: List[dict]) -> str:
+        stocks_total = meta.get('stocks_total', 0)
+        by_id = {doc['_id']: doc for doc in items}
+        lines = [
+            "📈 <b>Статистика появлений</b>\n",
+            f"Стоков учтено: <b>{stocks_total}</b> с {format_moment(meta.get('first_stock_at'))}\n",
+        ]
+        # Предметы каталога от редких к частым
+        catalog = sorted(AVAILABLE_ITEMS, key=lambda item_id: by_id.get(item_id, {}).get('appearances', 0))
+        for item_id in catalog:
+            item_info = AVAILABLE_ITEMS[item_id]
+            doc = by_id.get(item_id)
+            if not doc:
+                lines.append(f"{item_info['emoji']} {item_info['name']}: не появлялся")
+                continue
+            appearances = doc['appearances']
+            share = appearances / stocks_total * 100 if stocks_total else 0
+            lines.append(
+                f"{item_info['emoji']} {item_info['name']}: <b>{appearances}</b> ({share:.1f}%), "
+                f"~{doc['quantity_total'] / appearances:.1f} шт, {format_moment(doc.get('last_seen'))}"
+            )
+        lines.append("\n/stats &lt;предмет&gt; - подробнее о предмете")
+        return "\n".join(lines)
+
+    def format_item(self, meta: dict, item_id: str, doc: Optional[dict]) -> str:
+        item_info = AVAILABLE_ITEMS[item_id]
+        title = f"{item_info['emoji']} <b>{item_info['name']}</b> ({item_info['rarity']})\n"
+        if not doc:
+            return title + "\nЕще не появлялся в стоке"
+
+        stocks_total = meta.get('stocks_total', 0)
+        appearances = doc['appearances']
+        lines = [
+            title,
+            f"Появлений: <b>{appearances}</b> из {stocks_total} стоков "
+            f"({appearances / stocks_total * 100 if stocks_total else 0:.1f}%)",
+            f"Среднее количество: <b>{doc['quantity_total'] / appearances:.1f}</b>",
+            f"Первый раз: {format_moment(doc.get('first_seen'))}",
+            f"Последний раз: {format_moment(doc.get('last_seen'))}",
+        ]
+        gap_count = doc.get('gap_count', 0)
+        if gap_count:
+            lines.append(f"Средний интервал: <b>{format_minutes(doc['gap_sum_minutes'] / gap_count)}</b>\n")
+            lines.append("<b>Интервалы между появлениями:</b>")
+            gaps = doc.get('gaps', {})
+            for label in GAP_BUCKET_LABELS:
+                count = gaps.get(label, 0)
+                if count:
+                    lines.append(f"{gap_label(label)}: {count} ({count / gap_count * 100:.0f}%)")
+        return "\n".join(lines)
+
+    def render_forecast(self) -> Optional[str]:
+        """Прогноз по редким предметам. None - модель еще строится."""
+        if not self.forecast.ready:
+            return None
+        text = self.rendered.get(self.FORECAST_KEY)
+        if text is None:
+            lines = ["🔮 <b>Прогноз редких предметов</b>\n"]
+            for forecast in self.forecast.predict_all():
+                lines.append(self.format_forecast(forecast))
+            lines.append("\nОценка по интервалам между появлениями в истории, не гарантия")
+            text = "\n".join(lines)
+            self.rendered.set(self.FORECAST_KEY, text)
+        return text
+
+    @staticmethod
+    def format_forecast(forecast: Forecast) -> str:
+        item_info = AVAILABLE_ITEMS[forecast.item_id]
+        title = f"{item_info['emoji']} <b>{item_info['name']}</b> ({item_info['rarity']})"
+        seen = f"был {format_minutes(forecast.elapsed_minutes)} назад"
+        if forecast.median is not None:
+            return (
+                f"{title}: ~через {format_minutes(forecast.median)} "
+                f"({format_minutes(forecast.low)}–{format_minutes(forecast.high)}), "
+                f"в ближайший час {forecast.chance_hour * 100:.0f}%, {seen}"
+            )
+        if forecast.overdue:
+            return f"{title}: {seen} - дольше всех интервалов в истории"
+        return f"{title}: мало данных, {seen}"
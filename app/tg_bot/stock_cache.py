@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import os
+from typing import Callable, Dict, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# Интервал проверки нового стока, если change stream недоступен
+STOCK_CACHE_POLL_INTERVAL = float(os.getenv('STOCK_CACHE_POLL_INTERVAL', '2'))
+
+
+class StockCache:
+    """Кэш последних стоков и отрендеренных сообщений в памяти процесса.
+
+    Обновляется по change stream коллекции stocks, а если он недоступен
+    (MongoDB без replica set) - фоновым опросом самого свежего стока.
+    Обработчики команд читают только память.
+    """
+
+    def __init__(self, collection: AsyncIOMotorCollection, size: int, on_stock: Optional[Callable[[dict], None]] = None):
+        self.collection = collection
+        self.size = size
+        # Вызывается для каждого загруженного стока от старых к новым (повторы возможны)
+        self.on_stock = on_stock
+        self.stocks: List[dict] = []
+        self.ready = False
+        self._rendered: Dict[object, str] = {}
+        self.hits = 0
+        self.misses = 0
+        self._follow_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Первичная загрузка и запуск фонового обновления"""
+        if self._follow_task is not None:
+            return
+        await self.reload()
+        self._follow_task = asyncio.create_task(self._follow())
+
+    async def reload(self):
+        """Перечитать последние стоки и сбросить отрендеренные сообщения"""
+        stocks = await self.collection.find({}).sort('created_at', -1).limit(self.size).to_list(length=self.size)
+        self.stocks = stocks
+        self._rendered = {}
+        self.ready = True
+        if self.on_stock is not None:
+            for stock in reversed(stocks):
+                self.on_stock(stock)
+
+    @property
+    def latest(self) -> Optional[dict]:
+        return self.stocks[0] if self.stocks else None
+
+    def render(self, key, builder: Callable[[], str]) -> str:
+        """Вернуть сообщение из кэша или построить его один раз до следующего обновления"""
+        rendered = self._rendered.get(key)
+        if rendered is None:
+            self.misses += 1
+            rendered = builder()
+            self._rendered[key] = rendered
+        else:
+            self.hits += 1
+        return rendered
+
+    async def _follow(self):
+        try:
+            await self._watch()
+        except PyMongoError as e:
+            logger.warning(f"⚠️ Change stream для стоков недоступен ({e}), переключаюсь на опрос")
+        await self._poll()
+
+    async def _watch(self):
+        # Только вставки: архивация (archived_at) и удаление по TTL не меняют последние стоки
+        async with self.collection.watch([{'$match': {'operationType': 'insert'}}]) as stream:
+            logger.info("✅ Кэш стоков отслеживает change stream")
+            async for _ in stream:
+                await self.reload()
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(STOCK_CACHE_POLL_INTERVAL)
+            try:
+                newest = await self.collection.find_one({}, {'_id': 1}, sort=[('created_at', -1)])
+                newest_id = newest['_id'] if newest else None
+                latest_id = self.latest['_id'] if self.latest else None
+                if newest_id != latest_id:
+                    await self.reload()
+            except PyMongoError as e:
+                logger.error(f"❌ Ошибка обновления кэша стоков: {e}")
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from bson import Int64
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import PyMongoError
+
+from app.common.items import ITEM_BITS, items_to_mask
+
+logger = logging.getLogger(__name__)
+
+# Задержка отложенной записи подписок в секундах (0 - писать сразу)
+SUBSCRIPTION_WRITE_BEHIND_DELAY = float(os.getenv('SUBSCRIPTION_WRITE_BEHIND_DELAY', '0'))
+
+
+class SubscriptionStore:
+    """Запись подписок на предметы в plant_subscriptions.
+
+    Рядом со списком items хранится битовая маска items_mask (биты из
+    ITEM_BITS), по которой воркер ищет подписчиков. По умолчанию каждое
+    изменение - один атомарный find_one_and_update с $addToSet/$pull и $bit,
+    возвращающий обновленный документ. При включенной
+    отложенной записи быстрые нажатия одного пользователя копятся в памяти
+    и сбрасываются одним bulk_write.
+    """
+
+    def __init__(self, collection: AsyncIOMotorCollection, write_behind_delay: float = SUBSCRIPTION_WRITE_BEHIND_DELAY):
+        self.collection = collection
+        self.write_behind_delay = write_behind_delay
+        # user_id -> {'items': [...], 'username': ...} еще не записанные в базу
+        self._pending: Dict[int, dict] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def get_items(self, user_id: int) -> List[str]:
+        """Текущие подписки пользователя"""
+        pending = self._pending.get(user_id)
+        if pending is not None:
+            return list(pending['items'])
+        user_sub = await self.collection.find_one({'user_id': user_id}, {'items': 1})
+        return user_sub.get('items', []) if user_sub else []
+
+    async def set_item(self, user_id: int, username: Optional[str], item_id: str, subscribed: bool) -> List[str]:
+        """Подписать или отписать пользователя от предмета. Возвращает новый список подписок."""
+        if self.write_behind_delay > 0:
+            items = await self.get_items(user_id)
+            if subscribed and item_id not in items:
+                items.append(item_id)
+            elif not subscribed and item_id in items:
+                items.remove(item_id)
+            self._schedule(user_id, username, items)
+            return items
+
+        operator = '$addToSet' if subscribed else '$pull'
+        bit = ITEM_BITS[item_id]
+        mask_update = {'or': Int64(bit)} if subscribed else {'and': Int64(~bit)}
+        user_sub = await self.collection.find_one_and_update(
+            {'user_id': user_id},
+            {
+                operator: {'items': item_id},
+                '$bit': {'items_mask': mask_update},
+                '$set': {
+                    'user_id': user_id,
+                    'username': username,
+                    'updated_at': datetime.utcnow()
+                }
+            },
+            projection={'items': 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return user_sub.get('items', [])
+
+    async def clear(self, user_id: int) -> List[str]:
+        """Очистить все подписки пользователя"""
+        if self.write_behind_delay > 0:
+            pending = self._pending.get(user_id)
+            self._schedule(user_id, pending['username'] if pending else None, [])
+            return []
+
+        # Документ сохраняем, чтобы индекс воркера увидел изменение по updated_at
+        await self.collection.update_one(
+            {'user_id': user_id},
+            {'$set': {'items': [], 'items_mask': Int64(0), 'updated_at': datetime.utcnow()}}
+        )
+        return []
+
+    async def backfill_masks(self) -> int:
+        """Посчитать items_mask для документов, созданных до появления масок"""
+        operations = []
+        updated = 0
+        cursor = self.collection.find({'items_mask': {'$exists': False}}, {'items': 1}, batch_size=5000)
+        async for user_sub in cursor:
+            mask = items_to_mask(user_sub.get('items') or ())
+            operations.append(UpdateOne({'_id': user_sub['_id']}, {'$set': {'items_mask': Int64(mask)}}))
+            if len(operations) >= 1000:
+                updated += (await self.collection.bulk_write(operations, ordered=False)).modified_count
+                operations = []
+        if operations:
+            updated += (await self.collection.bulk_write(operations, ordered=False)).modified_count
+        return updated
+
+    def _schedule(self, user_id: int, username: Optional[str], items: List[str]):
+        self._pending[user_id] = {'items': items, 'username': username}
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.write_behind_delay)
+        await self.flush()
+
+    async def flush(self):
+        """Записать накопленные изменения одним bulk_write"""
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        now = datetime.utcnow()
+        operations = []
+        for user_id, state in pending.items():
+            fields = {
+                'user_id': user_id,
+                'items': state['items'],
+                'items_mask': Int64(items_to_mask(state['items'])),
+                'updated_at': now
+            }
+            if state['username'] is not None:
+                fields['username'] = state['username']
+            operations.append(UpdateOne({'user_id': user_id}, {'$set': fields}, upsert=True))
+
+        try:
+            await self.collection.bulk_write(operations, ordered=False)
+        except PyMongoError as e:
+            logger.error(f"❌ Ошибка записи подписок: {e}")
+            # Возвращаем неудачные изменения, если поверх них не появилось новых
+            for user_id, state in pending.items():
+                self._pending.setdefault(user_id, state)
+            if self._pending:
+                self._flush_task = asyncio.create_task(self._delayed_flush())
@@ -1,5 +1,6 @@
 import os
 import asyncio
+import logging
 from datetime import datetime, timezone, timedelta
 import sys
 
@@ -17,15 +18,30 @@ from telegram.ext import (
     filters
 )
 from telegram.constants import ChatMemberStatus
+from telegram.error import BadRequest
 
 
 from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorDatabase as MotorDatabase
 
 from mongo_init import get_db
+from app.common.appearance_forecast import AppearanceForecast
+from app.common.indexes import bootstrap_indexes
+from app.common.item_stats import ItemStats
+from app.common.items import AVAILABLE_ITEMS, ItemResolver, items_to_mask
+from app.common.logging_setup import setup_logging
+from app.common.lru_cache import TTLCache
+from app.common.metrics import register_cache, start_metrics_server
+from app.tg_bot.history import HISTORY_CALLBACK_PREFIX, StockHistoryPager
+from app.tg_bot.keyboards import AutostockKeyboard
+from app.tg_bot.stats_view import ItemStatsView
+from app.tg_bot.stock_cache import StockCache
+from app.tg_bot.subscription_store import SubscriptionStore
 
 load_dotenv()
 
+logger = logging.getLogger('tg_bot')
+
 # Настройки из переменных окружения
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
@@ -54,6 +70,11 @@ STOCKS_PER_PAGE = 6  # Текущий + 5 предыдущих
 # Московская временная зона
 MOSCOW_TZ = timezone(timedelta(hours=3))
 
+# Кэш подтверждения подписки на каналы
+SUBSCRIPTION_GATE_CACHE_SIZE = 500_000
+SUBSCRIPTION_CONFIRMED_TTL = 6 * 3600  # Подтверждение не отзывается, храним долго
+SUBSCRIPTION_UNCONFIRMED_TTL = 60      # Отрицательный результат живет недолго
+
 
 class StockBot:
     def __init__(self):
@@ -61,35 +82,81 @@ class StockBot:
         self.stock_collection = self.db.stocks
         self.subscriptions_collection = self.db.plant_subscriptions
         self.users_collection = self.db.users  # Добавляем коллекцию для пользователей
+        self.subscription_store = SubscriptionStore(self.subscriptions_collection)
+        
+        # Прогноз редких предметов дополняется новыми стоками из кэша стоков
+        self.appearance_forecast = AppearanceForecast()
+        
+        # Кэш последних стоков: /current и /history не ходят в базу
+        self.stock_cache = StockCache(
+            self.stock_collection, STOCKS_PER_PAGE, on_stock=self.appearance_forecast.apply_stock
+        )
         
-        # Список доступных предметов для подписки
-        # Теперь включаем и seeds и gear
-        self.available_items = {
-            # Seeds
-            'cactus_seed': {'emoji': '🌵', 'name': 'Cactus seed', 'type': 'seed', 'rarity': 'Rare'},
-            'strawberry_seed': {'emoji': '🍓', 'name': 'Strawberry seed', 'type': 'seed', 'rarity': 'Rare'},
-            'pumpkin_seed': {'emoji': '🎃', 'name': 'Pumpkin seed', 'type': 'seed', 'rarity': 'Epic'},
-            'sunflower_seed': {'emoji': '🌻', 'name': 'Sunflower seed', 'type': 'seed', 'rarity': 'Epic'},
-            'dragon_fruit_seed': {'emoji': '🐉', 'name': 'Dragon fruit seed', 'type': 'seed', 'rarity': 'Legendary'},
-            'eggplant_seed': {'emoji': '🍆', 'name': 'Eggplant seed', 'type': 'seed', 'rarity': 'Legendary'},
-            'watermelon_seed': {'emoji': '🍉', 'name': 'Watermelon seed', 'type': 'seed', 'rarity': 'Mythic'},
-            'grape_seed': {'emoji': '🍇', 'name': 'Grape seed', 'type': 'seed', 'rarity': 'Mythic'},
-            'cocotank_seed': {'emoji': '🥥', 'name': 'Cocotank seed', 'type': 'seed', 'rarity': 'Godly'},
-            'carnivorous_plant_seed': {'emoji': '🌿', 'name': 'Carnivorous plant seed', 'type': 'seed', 'rarity': 'Godly'},
-            'mr_carrot_seed': {'emoji': '🥕', 'name': 'Mr Carrot seed', 'type': 'seed', 'rarity': 'Secret'},
-            'tomatrio_seed': {'emoji': '🍅', 'name': 'Tomatrio seed', 'type': 'seed', 'rarity': 'Secret'},
-            'shroombino_seed': {'emoji': '🍄', 'name': 'Shroombino seed', 'type': 'seed', 'rarity': 'Secret'},
-            'mango_seed': {'emoji': '🥭', 'name': 'Mango seed', 'type': 'seed', 'rarity': 'Secret'},
-            'king_limon_seed': {'emoji': '🍋', 'name': 'King Limon seed', 'type': 'seed', 'rarity': 'Secret'},
-            'starfruit_seed': {'emoji': '🌟', 'name': 'Starfruit seed', 'type': 'seed', 'rarity': 'Secret'},
-            # Gear
-            'water_bucket': {'emoji': '🪣', 'name': 'Water Bucket', 'type': 'gear', 'rarity': 'Epic'},
-            'frost_grenade': {'emoji': '❄️', 'name': 'Frost Grenade', 'type': 'gear', 'rarity': 'Epic'},
-            'banana_gun': {'emoji': '🍌', 'name': 'Banana Gun', 'type': 'gear', 'rarity': 'Epic'},
-            'frost_blower': {'emoji': '🌬️', 'name': 'Frost Blower', 'type': 'gear', 'rarity': 'Legendary'},
-            'carrot_launcher': {'emoji': '🥕', 'name': 'Carrot Launcher', 'type': 'gear', 'rarity': 'Godly'}
-        }
+        # user_id -> подтвердил ли подписку на каналы
+        self.confirmed_users = TTLCache(SUBSCRIPTION_GATE_CACHE_SIZE, SUBSCRIPTION_CONFIRMED_TTL)
+        
+        # Список доступных предметов для подписки (seeds и gear)
+        self.available_items = AVAILABLE_ITEMS
+        # Таблица поиска предмета по названию из стока
+        self.item_resolver = ItemResolver(self.available_items)
+        # Раскладка меню автостока строится один раз
+        self.autostock_keyboard = AutostockKeyboard(self.available_items)
+        
+        # Листание истории дальше последних стоков, страницы кэшируются по курсору
+        self.history_pager = StockHistoryPager(
+            self.stock_collection,
+            STOCKS_PER_PAGE,
+            lambda stocks: self.format_history(stocks, latest=False)
+        )
         
+        # Статистика предметов по счетчикам, которые ведет воркер, и прогноз редких предметов
+        self.stats_view = ItemStatsView(ItemStats(self.db.item_stats), self.appearance_forecast)
+        
+        register_cache('stock_render', self.stock_cache)
+        register_cache('history_pages', self.history_pager.pages)
+        register_cache('subscription_gate', self.confirmed_users)
+        register_cache('item_resolver', self.item_resolver)
+        register_cache('item_stats', self.stats_view.rendered)
+        self.metrics_task = None
+        
+    async def post_init(self, application: Application):
+        """Прогрев кэшей после запуска приложения"""
+        self.metrics_task = await start_metrics_server()
+        await bootstrap_indexes(self.db)
+        await self.stock_cache.start()
+        await self.appearance_forecast.start(self.stock_collection, self.db.stock_archive)
+        logger.info(f"✅ Кэш стоков загружен: {len(self.stock_cache.stocks)} стоков")
+        await self.warm_subscription_cache()
+        logger.info(f"✅ Кэш подписок на каналы загружен: {len(self.confirmed_users)} пользователей")
+        backfilled = await self.subscription_store.backfill_masks()
+        if backfilled:
+            logger.info(f"✅ Маски подписок посчитаны для {backfilled} пользователей")
+    
+    async def warm_subscription_cache(self):
+        """Загрузить всех подтвердивших подписку пользователей одним запросом"""
+        cursor = self.users_collection.find(
+            {'subscription_confirmed': True},
+            {'user_id': 1, '_id': 0},
+            batch_size=10000
+        )
+        async for user_doc in cursor:
+            self.confirmed_users.set(user_doc['user_id'], True)
+    
+    async def is_subscription_confirmed(self, user_id: int) -> bool:
+        """Подтверждал ли пользователь подписку (из кэша, при промахе - из базы)"""
+        confirmed = self.confirmed_users.get(user_id)
+        if confirmed is None:
+            user_doc = await self.users_collection.find_one({'user_id': user_id}, {'subscription_confirmed': 1})
+            confirmed = user_doc.get('subscription_confirmed', False) if user_doc else False
+            self.confirmed_users.set(user_id, confirmed, ttl=None if confirmed else SUBSCRIPTION_UNCONFIRMED_TTL)
+        return confirmed
+    
+    async def get_recent_stocks(self) -> list:
+        """Последние стоки из кэша (или из базы, если кэш еще не загружен)"""
+        if self.stock_cache.ready:
+            return self.stock_cache.stocks
+        return await self.stock_collection.find({}).sort('created_at', -1).limit(STOCKS_PER_PAGE).to_list(length=STOCKS_PER_PAGE)
+    
     async def check_channel_subscription(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
         """Проверяет подписку пользователя на все необходимые каналы"""
         user_id = update.effective_user.id
@@ -98,9 +165,12 @@ class StockBot:
         if not REQUIRED_LINKS:
             return True
         
-        # Проверяем в базе данных, подтверждал ли пользователь подписку
-        user_doc = await self.users_collection.find_one({'user_id': user_id})
-        user_confirmed = user_doc.get('subscription_confirmed', False) if user_doc else False
+        # Подписка уже проверена для этого апдейта (text_handler -> обработчик команды)
+        if context.user_data is not None and context.user_data.get('gate_update_id') == update.update_id:
+            return True
+        
+        # Проверяем, подтверждал ли пользователь подписку
+        user_confirmed = await self.is_subscription_confirmed(user_id)
         
         if not user_confirmed:
             # Создаем клавиатуру со ссылками
@@ -130,6 +200,8 @@ class StockBot:
             
             return False
         
+        if context.user_data is not None:
+            context.user_data['gate_update_id'] = update.update_id
         return True
     
     async def is_private_chat(self, update: Update) -> bool:
@@ -176,20 +248,8 @@ class StockBot:
             message_parts.append("<b>🌱 Семена:</b>")
             for seed_name, quantity in seeds_stock.items():
                 # Находим эмодзи для семени
-                emoji = ''
-                normalized_seed = seed_name.lower().replace(' ', '_')
-                # Также проверяем вариант с добавлением "_seed"
-                normalized_seed_with_suffix = normalized_seed + '_seed' if not normalized_seed.endswith('_seed') else normalized_seed
-                
-                for item_id, item_info in self.available_items.items():
-                    if item_info['type'] == 'seed' and (
-                        item_info['name'].lower() == seed_name.lower() or 
-                        item_id == normalized_seed or
-                        item_id == normalized_seed_with_suffix or
-                        item_info['name'].lower().replace(' seed', '') == seed_name.lower()
-                    ):
-                        emoji = item_info['emoji'] + ' '
-                        break
+                item_info = self.item_resolver.get(seed_name, 'seed')
+                emoji = item_info['emoji'] + ' ' if item_info else ''
                 message_parts.append(f"{emoji}{seed_name}: <b>{quantity}</b>")
         
         # Снаряжение
@@ -198,15 +258,8 @@ class StockBot:
             message_parts.append("\n<b>⚔️ Снаряжение:</b>")
             for gear_name, quantity in gear_stock.items():
                 # Находим эмодзи для снаряжения
-                emoji = ''
-                normalized_gear = gear_name.lower().replace(' ', '_')
-                for item_id, item_info in self.available_items.items():
-                    if item_info['type'] == 'gear' and (
-                        item_info['name'].lower() == gear_name.lower() or 
-                        item_id == normalized_gear
-                    ):
-                        emoji = item_info['emoji'] + ' '
-                        break
+                item_info = self.item_resolver.get(gear_name, 'gear')
+                emoji = item_info['emoji'] + ' ' if item_info else ''
                 message_parts.append(f"{emoji}{gear_name}: <b>{quantity}</b>")
         
         return "\n".join(message_parts)
@@ -234,6 +287,8 @@ class StockBot:
             "<b>Доступные команды:</b>\n"
             "• /current - Показать текущий сток\n"
             "• /history - История стоков\n"
+            "• /stats - Статистика появлений предметов\n"
+            "• /forecast - Когда ждать редкие предметы\n"
             "• /autostock - Управление подписками\n\n"
             "Или используйте кнопки меню ниже 👇"
         )
@@ -254,14 +309,14 @@ class StockBot:
         if not await self.check_channel_subscription(update, context):
             return
             
-        # Находим сток с самым поздним created_at
-        current_stock = await self.stock_collection.find_one(
-            {},
-            sort=[('created_at', -1)]
-        )
+        # Сток с самым поздним created_at
+        stocks = await self.get_recent_stocks()
         
-        if current_stock:
-            message = self.format_stock(current_stock, is_current=True)
+        if stocks:
+            message = self.stock_cache.render(
+                ('current', stocks[0]['_id']),
+                lambda: self.format_stock(stocks[0], is_current=True)
+            )
             await update.message.reply_text(message, parse_mode='HTML')
         else:
             await update.message.reply_text(
@@ -281,7 +336,7 @@ class StockBot:
             return
             
         # Получаем 6 последних стоков
-        stocks = await self.stock_collection.find({}).sort('created_at', -1).limit(STOCKS_PER_PAGE).to_list(length=STOCKS_PER_PAGE)
+        stocks = await self.get_recent_stocks()
         
         if not stocks:
             await update.message.reply_text(
@@ -291,20 +346,90 @@ class StockBot:
             )
             return
         
-        # Формируем сообщение
+        message = self.stock_cache.render(('history', stocks[0]['_id']), lambda: self.format_history(stocks))
+        
+        await update.message.reply_text(
+            message,
+            parse_mode='HTML',
+            reply_markup=self.history_pager.first_page_markup(stocks)
+        )
+    
+    async def show_history_page(self, update: Update, context: ContextTypes.DEFAULT_TYPE, data: str):
+        """Перелистнуть историю стоков по кнопке"""
+        query = update.callback_query
+        page = await self.history_pager.page(data)
+        if page is None:
+            await query.answer("Стоков дальше нет")
+            return
+        
+        await query.answer()
+        try:
+            await query.edit_message_text(page.text, parse_mode='HTML', reply_markup=page.markup)
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                raise
+    
+    async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Статистика появлений: /stats - все предметы, /stats <предмет> - подробнее"""
+        # Проверяем, что это личный чат
+        if not await self.is_private_chat(update):
+            return
+            
+        # Проверяем подписку
+        if not await self.check_channel_subscription(update, context):
+            return
+        
+        item_id = None
+        if context.args:
+            item_id = self.item_resolver.resolve(' '.join(context.args))
+            if item_id is None:
+                await update.message.reply_text(
+                    "❓ Предмет не найден. Пример: /stats Mango seed",
+                    parse_mode='HTML'
+                )
+                return
+        
+        message = await self.stats_view.render(item_id)
+        if message is None:
+            await update.message.reply_text(
+                "📭 <b>Статистика еще не собрана</b>\n\n"
+                "Подождите, пока парсер соберет данные.",
+                parse_mode='HTML'
+            )
+            return
+        await update.message.reply_text(message, parse_mode='HTML')
+    
+    async def forecast_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Прогноз следующего появления Secret/Godly предметов"""
+        # Проверяем, что это личный чат
+        if not await self.is_private_chat(update):
+            return
+            
+        # Проверяем подписку
+        if not await self.check_channel_subscription(update, context):
+            return
+        
+        # Модель в памяти, новые стоки приходят в нее из кэша стоков
+        message = self.stats_view.render_forecast()
+        if message is None:
+            await update.message.reply_text(
+                "⏳ <b>Прогноз еще строится</b>\n\n"
+                "Попробуйте через минуту.",
+                parse_mode='HTML'
+            )
+            return
+        await update.message.reply_text(message, parse_mode='HTML')
+    
+    def format_history(self, stocks: list, latest: bool = True) -> str:
+        """Форматирование истории стоков в одно сообщение"""
         message_parts = ["📜 <b>История стоков</b>\n"]
         
         for i, stock in enumerate(stocks):
             message_parts.append(f"\n{'='*30}\n")
-            # Первый сток - текущий
-            message_parts.append(self.format_stock(stock, is_current=(i == 0)))
-        
-        message = "\n".join(message_parts)
+            # Первый сток последней страницы - текущий
+            message_parts.append(self.format_stock(stock, is_current=(latest and i == 0)))
         
-        await update.message.reply_text(
-            message,
-            parse_mode='HTML'
-        )
+        return "\n".join(message_parts)
     
     async def autostock_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Команда для управления автостоком"""
@@ -318,64 +443,23 @@ class StockBot:
             
         await self.show_autostock_menu(update, context, from_command=True)
     
-    async def show_autostock_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE, from_command: bool = False):
+    async def show_autostock_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE, from_command: bool = False, subscribed_items: list = None):
         """Показать меню управления подписками на предметы"""
         user_id = update.effective_user.id
         
-        # Получаем текущие подписки пользователя
-        user_sub = await self.subscriptions_collection.find_one({'user_id': user_id})
-        subscribed_items = user_sub.get('items', []) if user_sub else []
-        
-        # Создаем клавиатуру с предметами
-        keyboard = []
-        
-        # Сначала семена
-        keyboard.append([InlineKeyboardButton("🌱 СЕМЕНА", callback_data="noop")])
-        row = []
-        for item_id, item_info in self.available_items.items():
-            if item_info['type'] == 'seed':
-                is_subscribed = item_id in subscribed_items
-                button_text = f"{'✅' if is_subscribed else '❌'} {item_info['emoji']} {item_info['name']}"
-                callback_data = f"toggle_item_{item_id}"
-                
-                row.append(InlineKeyboardButton(button_text, callback_data=callback_data))
-                
-                if len(row) == 2:
-                    keyboard.append(row)
-                    row = []
-        
-        if row:
-            keyboard.append(row)
-        
-        # Затем снаряжение
-        keyboard.append([InlineKeyboardButton("⚔️ СНАРЯЖЕНИЕ", callback_data="noop")])
-        row = []
-        for item_id, item_info in self.available_items.items():
-            if item_info['type'] == 'gear':
-                is_subscribed = item_id in subscribed_items
-                button_text = f"{'✅' if is_subscribed else '❌'} {item_info['emoji']} {item_info['name']}"
-                callback_data = f"toggle_item_{item_id}"
-                
-                row.append(InlineKeyboardButton(button_text, callback_data=callback_data))
-                
-                if len(row) == 2:
-                    keyboard.append(row)
-                    row = []
-        
-        if row:
-            keyboard.append(row)
-        
-        # Кнопка очистки всех подписок
-        if subscribed_items:
-            keyboard.append([InlineKeyboardButton("🗑️ Отписаться от всех", callback_data="clear_subscriptions")])
+        # Получаем текущие подписки пользователя, если их не передали после изменения
+        if subscribed_items is None:
+            subscribed_items = await self.subscription_store.get_items(user_id)
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        # Готовая клавиатура: по маске подписок выбираются только отметки ✅/❌
+        mask = items_to_mask(subscribed_items)
+        reply_markup = self.autostock_keyboard.markup(mask)
         
         # Формируем сообщение
         message = "🔔 <b>Управление автостоком</b>\n\n"
         
-        if subscribed_items:
-            message += f"Вы подписаны на {len(subscribed_items)} предметов.\n"
+        if mask:
+            message += f"Вы подписаны на {mask.bit_count()} предметов.\n"
             message += "Вы получите уведомление, когда они появятся в стоке.\n\n"
         else:
             message += "Вы не подписаны ни на один предмет.\n\n"
@@ -386,11 +470,16 @@ class StockBot:
         if from_command:
             await update.message.reply_text(message, parse_mode='HTML', reply_markup=reply_markup)
         else:
-            await update.callback_query.edit_message_text(message, parse_mode='HTML', reply_markup=reply_markup)
+            try:
+                await update.callback_query.edit_message_text(message, parse_mode='HTML', reply_markup=reply_markup)
+            except BadRequest as e:
+                # Повторное нажатие той же кнопки не меняет меню
+                if 'not modified' not in str(e).lower():
+                    raise
             await update.callback_query.answer()
     
-    async def toggle_item_subscription(self, update: Update, context: ContextTypes.DEFAULT_TYPE, item_id: str):
-        """Переключить подписку на предмет"""
+    async def toggle_item_subscription(self, update: Update, context: ContextTypes.DEFAULT_TYPE, item_id: str, subscribe: bool = None):
+        """Подписать/отписать от предмета (subscribe=None - переключить)"""
         user_id = update.effective_user.id
         username = update.effective_user.username
         
@@ -399,47 +488,32 @@ class StockBot:
             await update.callback_query.answer("❌ Неизвестный предмет")
             return
         
-        # Получаем текущие подписки
-        user_sub = await self.subscriptions_collection.find_one({'user_id': user_id})
-        subscribed_items = user_sub.get('items', []) if user_sub else []
+        # Кнопки старых меню не знают состояния - определяем его по текущим подпискам
+        if subscribe is None:
+            subscribe = item_id not in await self.subscription_store.get_items(user_id)
+        
+        # Атомарно сохраняем и получаем обновленный список
+        subscribed_items = await self.subscription_store.set_item(user_id, username, item_id, subscribe)
         
-        # Переключаем подписку
         item_info = self.available_items[item_id]
-        if item_id in subscribed_items:
-            subscribed_items.remove(item_id)
-            await update.callback_query.answer(f"❌ Отписались от {item_info['emoji']} {item_info['name']}")
-        else:
-            subscribed_items.append(item_id)
+        if subscribe:
             await update.callback_query.answer(f"✅ Подписались на {item_info['emoji']} {item_info['name']}")
+        else:
+            await update.callback_query.answer(f"❌ Отписались от {item_info['emoji']} {item_info['name']}")
         
-        # Сохраняем в базу
-        await self.subscriptions_collection.update_one(
-            {'user_id': user_id},
-            {
-                '$set': {
-                    'user_id': user_id,
-                    'username': username,
-                    'items': subscribed_items,
-                    'updated_at': datetime.utcnow()
-                }
-            },
-            upsert=True
-        )
-        
-        # Обновляем меню
-        await self.show_autostock_menu(update, context)
+        # Обновляем меню без повторного чтения из базы
+        await self.show_autostock_menu(update, context, subscribed_items=subscribed_items)
     
     async def clear_all_subscriptions(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Очистить все подписки"""
         user_id = update.effective_user.id
         
-        # Удаляем подписки
-        await self.subscriptions_collection.delete_one({'user_id': user_id})
+        subscribed_items = await self.subscription_store.clear(user_id)
         
         await update.callback_query.answer("🗑️ Все подписки удалены")
         
         # Обновляем меню
-        await self.show_autostock_menu(update, context)
+        await self.show_autostock_menu(update, context, subscribed_items=subscribed_items)
     
     async def button_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик нажатий на inline кнопки"""
@@ -468,6 +542,7 @@ class StockBot:
                 },
                 upsert=True
             )
+            self.confirmed_users.set(user_id, True)
             
             await query.answer("✅ Отлично! Теперь вам доступны все функции бота", show_alert=True)
             
@@ -500,7 +575,13 @@ class StockBot:
         if not await self.check_channel_subscription(update, context):
             return
         
-        if data.startswith("toggle_item_"):
+        if data.startswith(HISTORY_CALLBACK_PREFIX):
+            await self.show_history_page(update, context, data)
+        elif data.startswith("sub_item_"):
+            await self.toggle_item_subscription(update, context, data[len("sub_item_"):], subscribe=True)
+        elif data.startswith("unsub_item_"):
+            await self.toggle_item_subscription(update, context, data[len("unsub_item_"):], subscribe=False)
+        elif data.startswith("toggle_item_"):
             item_id = data.replace("toggle_item_", "")
             await self.toggle_item_subscription(update, context, item_id)
         elif data == "clear_subscriptions":
@@ -529,33 +610,39 @@ class StockBot:
                 "❓ Неизвестная команда. Используйте меню или команды:\n"
                 "/current - текущий сток\n"
                 "/history - история стоков\n"
+                "/stats - статистика предметов\n"
+                "/forecast - прогноз редких предметов\n"
                 "/autostock - управление автостоком"
             )
 
 
 def main():
     """Основная функция запуска бота"""
+    setup_logging('tg_bot')
+    
     # Проверяем токен
     if not TELEGRAM_BOT_TOKEN:
-        print("❌ Ошибка: TELEGRAM_BOT_TOKEN не установлен в переменных окружения!")
+        logger.error("❌ Ошибка: TELEGRAM_BOT_TOKEN не установлен в переменных окружения!")
         return
     
     # Создаем экземпляр бота
     bot = StockBot()
     
     # Создаем приложение
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    app = Application.builder().token(TELEGRAM_BOT_TOKEN).post_init(bot.post_init).build()
     
     # Регистрируем обработчики
     app.add_handler(CommandHandler("start", bot.start_command))
     app.add_handler(CommandHandler("current", bot.current_stock_command))
     app.add_handler(CommandHandler("history", bot.history_command))
     app.add_handler(CommandHandler("autostock", bot.autostock_command))
+    app.add_handler(CommandHandler("stats", bot.stats_command))
+    app.add_handler(CommandHandler("forecast", bot.forecast_command))
     app.add_handler(CallbackQueryHandler(bot.button_callback))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.text_handler))
     
     # Запускаем бота
-    print("🤖 Бот запущен и готов к работе!")
+    logger.info("🤖 Бот запущен и готов к работе!")
     app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
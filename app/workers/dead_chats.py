@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Callable, Dict, Optional, Set
+
+from bson import Int64
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# Как часто записывать деактивацию подписок в базу
+DEAD_CHAT_FLUSH_INTERVAL = float(os.getenv('DEAD_CHAT_FLUSH_INTERVAL', '5'))
+# Как часто выводить отчет о пропущенных отправках
+DEAD_CHAT_REPORT_INTERVAL = float(os.getenv('DEAD_CHAT_REPORT_INTERVAL', '600'))
+
+
+class DeadChatRegistry:
+    """Реестр чатов, в которые доставить сообщение больше нельзя.
+
+    Пользователь попадает сюда после Forbidden/«chat not found», сразу
+    исключается из рассылки, а его подписки пачками деактивируются в базе:
+    items переносятся в deactivated_items, маска обнуляется.
+    """
+
+    def __init__(self, collection: AsyncIOMotorCollection, on_dead: Optional[Callable[[int], None]] = None):
+        self.collection = collection
+        # Вызывается сразу при пометке - например, чтобы убрать пользователя из индекса подписок
+        self.on_dead = on_dead
+        # chat_id -> время пометки
+        self.dead: Dict[int, datetime] = {}
+        self._pending: Set[int] = set()
+        self.skipped = 0
+        self.skipped_total = 0
+        self._tasks = []
+
+    def __contains__(self, chat_id) -> bool:
+        return chat_id in self.dead
+
+    def __len__(self) -> int:
+        return len(self.dead)
+
+    def mark_dead(self, chat_id: int):
+        if chat_id in self.dead:
+            return
+        self.dead[chat_id] = datetime.utcnow()
+        self._pending.add(chat_id)
+        if self.on_dead:
+            self.on_dead(chat_id)
+
+    def revive(self, chat_id: int, updated_at: Optional[datetime] = None):
+        """Пользователь снова подписался после пометки - значит, чат жив"""
+        marked_at = self.dead.get(chat_id)
+        if marked_at is None:
+            return
+        # Изменения подписок, сделанные до пометки, чат не оживляют
+        if updated_at is not None and updated_at <= marked_at:
+            return
+        del self.dead[chat_id]
+        self._pending.discard(chat_id)
+
+    def record_skipped(self):
+        self.skipped += 1
+
+    async def start(self):
+        if self._tasks:
+            return
+        self._tasks.append(asyncio.create_task(self._flush_loop()))
+        self._tasks.append(asyncio.create_task(self._report_loop()))
+
+    async def flush(self):
+        """Деактивировать подписки накопившихся мертвых чатов одним запросом"""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, set()
+        now = datetime.utcnow()
+        try:
+            await self.collection.update_many(
+                {'user_id': {'$in': list(pending)}, 'items': {'$ne': []}},
+                [{'$set': {
+                    'deactivated_items': '$items',
+                    'items': {'$literal': []},
+                    'items_mask': Int64(0),
+                    'deactivated_at': now,
+                    'updated_at': now
+                }}]
+            )
+        except PyMongoError:
+            self._pending |= pending
+            raise
+        logger.info(f"🪦 Деактивированы подписки {len(pending)} пользователей, заблокировавших бота")
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(DEAD_CHAT_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except PyMongoError as e:
+                logger.error(f"❌ Ошибка деактивации подписок: {e}")
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(DEAD_CHAT_REPORT_INTERVAL)
+            self.skipped_total += self.skipped
+            logger.info(
+                f"🪦 Мертвых чатов: {len(self.dead)}, пропущено отправок за период: {self.skipped} "
+                f"(всего: {self.skipped_total})"
+            )
+            self.skipped = 0
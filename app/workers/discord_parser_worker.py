@@ -1,9 +1,11 @@
 import discord
 from discord.ext import commands
 import asyncio
+import logging
 import os
 import re
-from datetime import timezone, timedelta, datetime
+from datetime import timezone, timedelta
+from bson import ObjectId
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorDatabase
 import sys
@@ -12,12 +14,30 @@ from telegram.request import HTTPXRequest
 import time
 
 # Добавляем путь к корневой директории
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 from mongo_init import get_db
+from app.common.appearance_forecast import AppearanceForecast
+from app.common.indexes import bootstrap_indexes
+from app.common.item_stats import ItemStats, format_minutes
+from app.common.items import ITEM_BITS, item_resolver
+from app.common.logging_setup import setup_logging
+from app.common.metrics import (
+    CACHE_REQUESTS, RARE_ALERT_SECONDS, STOCK_INSERT_SECONDS, STOCK_PARSE_SECONDS,
+    register_cache, registry, start_metrics_server
+)
+from app.common.notification_render import StockNotificationRenderer
+from app.common.telegram_dispatcher import LANE_CHANNEL, TELEGRAM_LANE_CONNECTIONS, TelegramDispatcher
+from app.workers.dead_chats import DeadChatRegistry
+from app.workers.notification_outbox import NotificationOutbox
+from app.workers.stock_embed_parser import parse_stock_embed, record_embed
+from app.workers.stock_retention import StockRetention
+from app.workers.subscription_index import SubscriptionIndex
 
 # Загружаем переменные окружения
 load_dotenv()
 
+logger = logging.getLogger('discord_parser_worker')
+
 # Настройки Discord
 DISCORD_TOKEN = os.getenv('DISCORD_BOT_TOKEN')
 CHANNEL_ID = int(os.getenv('DISCORD_CHANNEL_ID', '1421601402425311362'))
@@ -27,20 +47,33 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 
 # Создаем бота с большим пулом соединений
 if TELEGRAM_BOT_TOKEN:
-    # Настройка пула соединений: 100 соединений для большого количества пользователей
+    # Пул соединений делится между полосами диспетчера (канал, рассылка)
     request = HTTPXRequest(
-        connection_pool_size=100,        # Максимум 100 одновременных соединений
+        connection_pool_size=sum(TELEGRAM_LANE_CONNECTIONS.values()),
         connect_timeout=60.0,            # Таймаут соединения
         read_timeout=60.0,               # Таймаут чтения
         write_timeout=60.0,              # Таймаут записи
         pool_timeout=60.0                # Таймаут получения соединения из пула
     )
     telegram_bot = Bot(token=TELEGRAM_BOT_TOKEN, request=request)
+    # Все отправки идут через диспетчер: token bucket на 30 сообщений/сек и повтор после RetryAfter
+    telegram_dispatcher = TelegramDispatcher(telegram_bot)
 else:
     telegram_bot = None
+    telegram_dispatcher = None
 
 NOTIFICATION_CHANNEL_ID = os.getenv('NOTIFICATION_CHANNEL_ID')  # ID канала для уведомлений о редких предметах
 
+# Список редких предметов для уведомления в канал
+RARE_SEEDS = {
+    'mr_carrot_seed',
+    'tomatrio_seed',
+    'carnivorous_plant_seed',
+    'shroombino_seed',
+    'mango_seed',
+    'king_limon_seed',
+}
+
 # Включаем intents
 intents = discord.Intents.default()
 intents.message_content = True
@@ -52,133 +85,135 @@ bot = commands.Bot(command_prefix="!", intents=intents)
 # MongoDB collections
 db: AsyncIOMotorDatabase = None
 
-# Семафор для ограничения одновременных запросов к Telegram API
-# Telegram лимит: 30 сообщений в секунду, но пул соединений может быть больше
-telegram_semaphore = asyncio.Semaphore(30)  # Ограничиваем до 30 одновременных запросов (соблюдаем rate limit)
+# Инвертированный индекс подписок (строится в on_ready)
+subscription_index: SubscriptionIndex = None
+
+# Чаты, заблокировавшие бота: исключаются из рассылки, подписки деактивируются
+dead_chats: DeadChatRegistry = None
+
+# Персистентная очередь уведомлений (разбирается пулом отправителей)
+notification_outbox: NotificationOutbox = None
+
+# Перенос старых стоков в дневные бакеты архива
+stock_retention: StockRetention = None
+
+# Счетчики появлений предметов для /stats (обновляются каждым стоком)
+item_stats: ItemStats = None
+
+# Прогноз следующего появления редких предметов для поста в канал
+appearance_forecast: AppearanceForecast = None
+
+# Эндпоинт /metrics (запускается в on_ready)
+metrics_task: asyncio.Task = None
+SUBSCRIBED_USERS = registry.gauge('subscription_index_users', "Пользователей с подписками в индексе")
+DEAD_CHATS = registry.gauge('dead_chats', "Чатов, заблокировавших бота")
+register_cache('item_resolver', item_resolver)
+
+
+def collect_worker_gauges():
+    if subscription_index is not None:
+        SUBSCRIBED_USERS.set(len(subscription_index))
+    if dead_chats is not None:
+        DEAD_CHATS.set(len(dead_chats))
+
+
+registry.add_collector(collect_worker_gauges)
+
+def build_notification_renderer(stock_data):
+    """Шаблон автосток-уведомлений для стока: строка каждого предмета строится один раз"""
+    # Бит предмета -> строка для уведомления
+    item_lines = {}
 
-async def send_user_notification(user_id, subscribed_items, stock_data):
-    """Отправляет уведомление одному пользователю"""
-    if not subscribed_items:
-        return
-        
-    print(f"\nПроверяем подписки пользователя {user_id}: {subscribed_items}")
-    
-    # Проверяем совпадения
-    matched_items = []
-    
-    # Проверяем семена
     for seed_name, quantity in stock_data.get('seeds_stock', {}).items():
-        # Нормализуем название для сравнения
-        normalized = seed_name.lower().replace(' ', '_')
-        seed_key = f"{normalized}_seed" if not normalized.endswith('_seed') else normalized
-        
-        # Проверяем различные варианты
-        if (normalized in subscribed_items or 
-            seed_key in subscribed_items or
-            f"{normalized.replace('_', '')}_seed" in subscribed_items):
-            matched_items.append(f"🌱 {seed_name}: {quantity}")
-            print(f"  ✅ Найдено совпадение для семени: {seed_name} -> {seed_key}")
-    
-    # Проверяем снаряжение  
+        item_id = item_resolver.resolve(seed_name, 'seed')
+        if item_id:
+            item_lines[ITEM_BITS[item_id]] = f"🌱 {seed_name}: {quantity}"
+
     for gear_name, quantity in stock_data.get('gear_stock', {}).items():
-        normalized = gear_name.lower().replace(' ', '_')
-        
-        if normalized in subscribed_items:
-            matched_items.append(f"⚔️ {gear_name}: {quantity}")
-            print(f"  ✅ Найдено совпадение для снаряжения: {gear_name} -> {normalized}")
-    
-    if matched_items:
-        print(f"  📨 Отправляем уведомление с {len(matched_items)} предметами")
-        message = "🔔 <b>Автосток уведомление!</b>\n\n"
-        message += "В новом стоке появились ваши предметы:\n\n"
-        message += "\n".join(matched_items)
-        message += "\n\n/current - посмотреть полный сток"
-        
-        async with telegram_semaphore:
-            try:
-                await telegram_bot.send_message(
-                    chat_id=user_id,
-                    text=message,
-                    parse_mode='HTML',
-                    disable_web_page_preview=True
-                )
-                print(f"  ✅ Уведомление отправлено")
-            except Exception as e:
-                print(f"  ❌ Ошибка отправки: {e}")
-
-async def send_notifications(stock_data):
-    """Отправляет уведомления подписчикам параллельно"""
-    if not telegram_bot:
+        item_id = item_resolver.resolve(gear_name, 'gear')
+        if item_id:
+            item_lines[ITEM_BITS[item_id]] = f"⚔️ {gear_name}: {quantity}"
+
+    return StockNotificationRenderer(
+        "🔔 <b>Автосток уведомление!</b>\n\nВ новом стоке появились ваши предметы:\n\n",
+        item_lines,
+        "\n\n/current - посмотреть полный сток"
+    )
+
+def iter_notifications(renderer):
+    """Находит подписчиков для стока одной векторной операцией по маскам подписок.
+
+    Лениво отдает пары (user_id, текст уведомления), чтобы очередь писалась
+    пачками по мере перебора. Пользователи с одинаковым набором совпадений
+    получают один и тот же объект строки.
+    """
+    stock_mask = 0
+    for bit in renderer.item_lines:
+        stock_mask |= bit
+
+    if not stock_mask:
+        return
+
+    user_ids, matched_masks = subscription_index.match(stock_mask)
+
+    for user_id, mask in zip(user_ids.tolist(), matched_masks.tolist()):
+        yield user_id, renderer.render(
+            (bit for bit in renderer.item_lines if mask & bit),
+            cache_key=mask
+        )
+
+async def send_notifications(stock_data, received_at=None):
+    """Ставит уведомления подписчикам в персистентную очередь"""
+    if not telegram_bot or subscription_index is None or notification_outbox is None:
         return
     
     start_time = time.time()
-    print(f"\n{'='*60}")
-    print(f"🚀 [{datetime.now().strftime('%H:%M:%S')}] НАЧАЛО отправки уведомлений пользователям")
-    
-    # Получаем подписчиков
-    subscriptions = await db.plant_subscriptions.find({}).to_list(length=None)
-    
-    # Отладка - выводим что пришло в стоке
-    print("\n=== НОВЫЙ СТОК ===")
-    print("Семена:", stock_data.get('seeds_stock', {}))
-    print("Снаряжение:", stock_data.get('gear_stock', {}))
-    print(f"Подписчиков в базе: {len(subscriptions)}")
+    logger.debug(
+        "Новый сток: семена %s, снаряжение %s, подписчиков в индексе: %d",
+        stock_data.get('seeds_stock', {}), stock_data.get('gear_stock', {}), len(subscription_index)
+    )
     
-    # Создаем задачи для отправки уведомлений всем пользователям параллельно
-    tasks = []
-    for subscription in subscriptions:
-        user_id = subscription.get('user_id')
-        subscribed_items = subscription.get('items', [])
-        task = send_user_notification(user_id, subscribed_items, stock_data)
-        tasks.append(task)
+    # Выбираем только пользователей, чьи предметы есть в стоке, и пишем их в очередь пачками.
+    # Доставкой занимается пул отправителей очереди - он начинает работу после первой пачки
+    renderer = build_notification_renderer(stock_data)
+    if received_at is not None:
+        notification_outbox.track(stock_data['_id'], received_at)
+    enqueued = await notification_outbox.enqueue(stock_data['_id'], iter_notifications(renderer))
     
-    # Запускаем все задачи параллельно
-    if tasks:
-        await asyncio.gather(*tasks, return_exceptions=True)
+    CACHE_REQUESTS.inc(renderer.hits, cache='notification_render', result='hit')
+    CACHE_REQUESTS.inc(renderer.misses, cache='notification_render', result='miss')
     
-    elapsed = time.time() - start_time
-    print(f"✅ [{datetime.now().strftime('%H:%M:%S')}] ЗАВЕРШЕНА отправка уведомлений пользователям")
-    print(f"⏱️  Время выполнения: {elapsed:.2f} секунд")
-    print(f"{'='*60}\n")
+    logger.info(
+        "✅ %d уведомлений поставлено в очередь за %.2f с, уникальных сообщений: %d",
+        enqueued, time.time() - start_time, len(renderer)
+    )
 
-async def check_rare_items(stock_data):
+def format_next_appearance(item_id, created_at):
+    """Когда ждать предмет снова - по интервалам из истории (пусто, если оценки нет)"""
+    if appearance_forecast is None or item_id not in appearance_forecast:
+        return ""
+    forecast = appearance_forecast.predict(item_id, now=created_at, since=created_at)
+    if forecast is None or forecast.median is None:
+        return ""
+    return f"\n    🔮 снова через ~{format_minutes(forecast.median)} (обычно {format_minutes(forecast.low)}–{format_minutes(forecast.high)})"
+
+async def check_rare_items(stock_data, received_at=None):
     """Проверяет наличие редких предметов и отправляет в канал"""
     if not telegram_bot or not NOTIFICATION_CHANNEL_ID:
         return
     
     start_time = time.time()
-    print(f"\n{'='*60}")
-    print(f"💎 [{datetime.now().strftime('%H:%M:%S')}] НАЧАЛО проверки редких предметов")
-    
-    # Список редких предметов
-    rare_seeds = [
-        'mr_carrot_seed',
-        'tomatrio_seed',
-        'carnivorous_plant_seed',
-        "shroombino_seed",
-        "mango_seed",
-        "king_limon_seed",
-    ]
-    
     found_rare = []
     
     # Проверяем семена
     for seed_name, quantity in stock_data.get('seeds_stock', {}).items():
-        # Нормализуем название для сравнения
-        normalized = seed_name.lower().replace(' ', '_').strip()
-        if not normalized.endswith('_seed'):
-            normalized = f"{normalized}_seed"
-        
         # Проверяем, является ли семя редким
-        if normalized in rare_seeds:
-            found_rare.append(f"💎 {seed_name}: {quantity}")
-            print(f"  🎯 Найден редкий предмет: {seed_name}")
+        item_id = item_resolver.resolve(seed_name, 'seed')
+        if item_id in RARE_SEEDS:
+            found_rare.append(f"💎 {seed_name}: {quantity}{format_next_appearance(item_id, stock_data['created_at'])}")
     
     # Если нашли редкие предметы, отправляем в канал
     if found_rare:
-        print(f"\n🎉 Найдено {len(found_rare)} редких предметов!")
-        print(f"📨 Отправляем уведомление в канал {NOTIFICATION_CHANNEL_ID}...")
-        
         message = "🚨 <b>РЕДКИЕ ПРЕДМЕТЫ В НОВОМ СТОКЕ!</b> 🚨\n\n"
         message += "\n".join(found_rare)
         
@@ -188,38 +223,101 @@ async def check_rare_items(stock_data):
         message += f"\n\n📅 Время: {moscow_time.strftime('%H:%M МСК')}"
         message += f"\n\n🎉 <a href='https://t.me/plantsvsbrainrot_stock_bot'>Наш бот с кастомными стоками</a>"
         
-        # Отправляем без семафора - это приоритетное сообщение (1 сообщение в канал)
+        # Сообщение в канал идет по приоритетной полосе: не ждет соединений и токенов рассылки
         try:
-            await telegram_bot.send_message(
-                chat_id=NOTIFICATION_CHANNEL_ID,
-                text=message,
+            await telegram_dispatcher.send_message(
+                NOTIFICATION_CHANNEL_ID,
+                message,
+                lane=LANE_CHANNEL,
                 parse_mode='HTML',
                 disable_web_page_preview=True
             )
-            elapsed = time.time() - start_time
-            print(f"✅ [{datetime.now().strftime('%H:%M:%S')}] Уведомление о редких предметах отправлено")
-            print(f"⏱️  Время выполнения: {elapsed:.2f} секунд")
+            if received_at is not None:
+                RARE_ALERT_SECONDS.observe(time.perf_counter() - received_at)
+            logger.info(
+                "💎 Уведомление о %d редких предметах отправлено в канал за %.2f с",
+                len(found_rare), time.time() - start_time
+            )
         except Exception as e:
-            print(f"❌ Ошибка отправки в канал: {e}")
+            logger.error("❌ Ошибка отправки в канал: %s", e)
     else:
-        print("ℹ️  Редких предметов не найдено")
-    
-    print(f"{'='*60}\n")
+        logger.debug("Редких предметов не найдено")
+
+async def save_stock(stock_data):
+    with STOCK_INSERT_SECONDS.time(source='discord'):
+        await db.stocks.insert_one(stock_data)
+
+async def resume_notifications():
+    """Дослать в очередь рассылку последнего стока, если ее постановка прервалась"""
+    try:
+        stock = await db.stocks.find_one({}, sort=[('created_at', -1)])
+        if stock is None or not await notification_outbox.needs_resume(stock):
+            return
+        logger.info("♻️ Рассылка стока %s не была поставлена в очередь полностью, повторяю", stock['_id'])
+        await send_notifications(stock)
+    except Exception as e:
+        logger.error("❌ Ошибка повторной постановки рассылки: %s", e)
+
+async def update_item_stats(stock_data):
+    if item_stats is not None:
+        await item_stats.record_stock(stock_data)
+    if appearance_forecast is not None:
+        await appearance_forecast.record_stock(stock_data)
 
 @bot.event
 async def on_ready():
-    global db
+    global db, subscription_index, notification_outbox, dead_chats, metrics_task, stock_retention, item_stats, appearance_forecast
     
-    print(f"✅ Бот {bot.user} онлайн!")
-    print(f"📍 Мониторинг канала ID: {CHANNEL_ID}")
+    logger.info("✅ Бот %s онлайн, мониторинг канала ID: %s", bot.user, CHANNEL_ID)
     
     # Подключаемся к MongoDB
     db = get_db()
     
-    print("✅ MongoDB подключена")
-    print("=" * 60)
-    print("🔍 Ожидаю сообщения с 'Plants vs Brainrots Stock' в заголовке...")
-    print("-" * 60)
+    if metrics_task is None:
+        metrics_task = await start_metrics_server()
+    
+    # on_ready вызывается повторно при переподключении - индекс строим один раз
+    if subscription_index is None:
+        try:
+            await bootstrap_indexes(db)
+        except RuntimeError as e:
+            # Исключение из on_ready discord.py только логирует - останавливаем воркер сами
+            logger.error("❌ %s", e)
+            await bot.close()
+            return
+        dead_chats = DeadChatRegistry(db.plant_subscriptions)
+        subscription_index = SubscriptionIndex(db.plant_subscriptions, on_subscribed=dead_chats.revive)
+        # Заблокировавший бота пользователь сразу пропадает из индекса, не дожидаясь записи в базу
+        dead_chats.on_dead = subscription_index.remove_user
+        await subscription_index.start()
+        await dead_chats.start()
+    logger.info("✅ Индекс подписок построен: %d пользователей", len(subscription_index))
+    
+    if stock_retention is None:
+        stock_retention = StockRetention(db.stocks, db.stock_archive)
+        await stock_retention.create_indexes()
+        await stock_retention.start()
+    
+    if item_stats is None:
+        item_stats = ItemStats(db.item_stats)
+        # При первом запуске статистика пересобирается по истории в фоне
+        await item_stats.start(db.stocks, db.stock_archive)
+    
+    if appearance_forecast is None:
+        appearance_forecast = AppearanceForecast()
+        await appearance_forecast.start(db.stocks, db.stock_archive)
+    
+    # Пул отправителей продолжает доставки, прерванные перезапуском
+    if telegram_dispatcher and notification_outbox is None:
+        notification_outbox = NotificationOutbox(
+            db.notification_outbox, telegram_dispatcher,
+            dead_chats=dead_chats, enqueues=db.notification_enqueues
+        )
+        await notification_outbox.create_indexes()
+        await notification_outbox.start()
+        logger.info("✅ Очередь уведомлений запущена")
+        await resume_notifications()
+    logger.info("🔍 Ожидаю сообщения со стоком от 'PVB Stock Alerts'")
 
 @bot.event
 async def on_message(message):
@@ -233,49 +331,53 @@ async def on_message(message):
     if 'PVB Stock Alerts' not in message.author.name:
         return
 
+    if not message.embeds:
+        logger.warning("⚠️ Сообщение %s без embed пропущено", message.id)
+        return
+
+    received_at = time.perf_counter()
     embed = message.embeds[0]
-    seeds_stock = embed.fields[0].value
-    gear_stock = embed.fields[1].value
-
-    seeds_stock_list = seeds_stock.split("\n")
-    seeds_stock = {}
-    for seed in seeds_stock_list:
-        seed_name = seed.split(">")[1].split("**x")[0].strip().replace("*", "")
-        seed_value = int(seed.split("**x")[1][0])
-        seeds_stock[seed_name] = seed_value
-
-    gear_stock_list = gear_stock.split("\n")
-    gear_stock = {}
-    for gear in gear_stock_list:
-        gear_name = gear.split(">")[1].split("**x")[0].strip().replace("*", "")
-        gear_value = int(gear.split("**x")[1][0])
-        gear_stock[gear_name] = gear_value
+    record_embed(embed)
+
+    with STOCK_PARSE_SECONDS.time(source='discord'):
+        parsed = parse_stock_embed(embed)
+    if parsed.errors:
+        logger.warning("⚠️ Не удалось разобрать строки стока: %s", parsed.errors)
+    if not parsed:
+        logger.warning("⚠️ В сообщении %s не найден сток", message.id)
+        return
 
     stock_data = {
         "created_at": message.created_at,
-        "seeds_stock": seeds_stock,
-        "gear_stock": gear_stock
+        "seeds_stock": parsed.seeds_stock,
+        "gear_stock": parsed.gear_stock
     }
+    # _id задаем сами: очереди уведомлений он нужен, не дожидаясь записи стока
+    stock_data['_id'] = ObjectId()
 
-    print(f"\n{'#'*60}")
-    print(f"📦 [{datetime.now().strftime('%H:%M:%S')}] НОВЫЙ СТОК ПОЛУЧЕН И СОХРАНЕН В БД")
-    print(f"{'#'*60}")
-    
-    await db.stocks.insert_one(stock_data)
-    
-    # Сначала отправляем уведомление о редких предметах (приоритет)
-    await check_rare_items(stock_data)
-    
-    # Затем отправляем уведомления пользователям
-    await send_notifications(stock_data)
+    # Запись стока, пост о редких предметах, постановка рассылки и статистика идут одновременно
+    results = await asyncio.gather(
+        save_stock(stock_data),
+        check_rare_items(stock_data, received_at),
+        send_notifications(stock_data, received_at),
+        update_item_stats(stock_data),
+        return_exceptions=True
+    )
+    for step, result in zip(('запись стока', 'редкие предметы', 'рассылка', 'статистика'), results):
+        if isinstance(result, Exception):
+            logger.error("❌ Ошибка обработки стока (%s): %s", step, result)
     
-    print(f"{'#'*60}")
-    print(f"🎉 [{datetime.now().strftime('%H:%M:%S')}] ВСЕ УВЕДОМЛЕНИЯ ОТПРАВЛЕНЫ")
-    print(f"{'#'*60}\n")
+    logger.info(
+        "📦 Сток %s обработан за %.3f с: %d семян, %d снаряжения",
+        stock_data['_id'], time.perf_counter() - received_at,
+        len(parsed.seeds_stock), len(parsed.gear_stock)
+    )
 
 if __name__ == "__main__":
+    setup_logging('discord_parser_worker')
     if not DISCORD_TOKEN:
-        print("❌ Ошибка: DISCORD_BOT_TOKEN не установлен!")
+        logger.error("❌ Ошибка: DISCORD_BOT_TOKEN не установлен!")
     else:
-        print("🚀 Запускаю Plants vs Brainrots Stock Monitor (MongoDB)...")
-        bot.run(DISCORD_TOKEN)
+        logger.info("🚀 Запускаю Plants vs Brainrots Stock Monitor (MongoDB)...")
+        # Логи discord.py идут через общую очередь, а не через собственный обработчик
+        bot.run(DISCORD_TOKEN, log_handler=None)
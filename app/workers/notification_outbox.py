@@ -0,0 +1,383 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError, ConnectionFailure, OperationFailure, PyMongoError
+from app.common.logging_setup import SAMPLED
+from app.common.metrics import NOTIFICATION_FIRST_SECONDS, NOTIFICATION_LAST_SECONDS
+from app.common.telegram_dispatcher import (
+    ERROR_DEAD_CHAT, ERROR_RETRYABLE, LANE_BULK, TelegramDispatcher, classify_error
+)
+from app.workers.dead_chats import DeadChatRegistry
+
+logger = logging.getLogger(__name__)
+
+# Количество задач-отправителей
+OUTBOX_SENDERS = int(os.getenv('OUTBOX_SENDERS', '100'))
+# Сколько доставок забирать из коллекции за раз
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '500'))
+# Как часто сбрасывать отметки о доставке в базу (меньше - меньше дублей после падения)
+OUTBOX_FLUSH_INTERVAL = float(os.getenv('OUTBOX_FLUSH_INTERVAL', '0.5'))
+# Первая пачка меньше остальных, чтобы первое сообщение ушло как можно раньше
+OUTBOX_FIRST_CHUNK_SIZE = 50
+# Повторы записи пачки при обрыве соединения с MongoDB (пауза удваивается)
+OUTBOX_INSERT_RETRIES = int(os.getenv('OUTBOX_INSERT_RETRIES', '5'))
+OUTBOX_INSERT_RETRY_DELAY = 1.0
+# Постановка в очередь, прерванная падением, досылается при старте, только если сток свежий
+OUTBOX_RESUME_MAX_AGE = int(os.getenv('OUTBOX_RESUME_MAX_AGE', '600'))
+# Через сколько секунд незавершенная доставка снова становится доступной
+OUTBOX_LEASE_SECONDS = int(os.getenv('OUTBOX_LEASE_SECONDS', '120'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '3'))
+# Сколько хранить завершенные записи (доставленные, неудачные и пропущенные)
+OUTBOX_RETENTION_SECONDS = int(os.getenv('OUTBOX_RETENTION_SECONDS', str(24 * 3600)))
+# Как часто проверять коллекцию, если новых доставок не поступало
+OUTBOX_IDLE_POLL_INTERVAL = 5.0
+
+STATUS_PENDING = 'pending'
+STATUS_SENDING = 'sending'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+# Чат мертв (бот заблокирован) - отправка не выполнялась
+STATUS_SKIPPED = 'skipped'
+
+
+class NotificationOutbox:
+    """Персистентная очередь уведомлений в MongoDB.
+
+    Доставки записываются в коллекцию до отправки, забираются пачками
+    с арендой (lease) и отмечаются выполненными пачками. После падения
+    воркера незавершенные доставки снова забираются по истечении аренды.
+    Полностью поставленный в очередь сток отмечается в коллекции enqueues:
+    постановку без отметки можно повторить (уникальный индекс
+    (stock_id, chat_id) не создаст дублей).
+    """
+
+    def __init__(
+        self,
+        collection: AsyncIOMotorCollection,
+        dispatcher: TelegramDispatcher,
+        senders: int = OUTBOX_SENDERS,
+        batch_size: int = OUTBOX_BATCH_SIZE,
+        dead_chats: Optional[DeadChatRegistry] = None,
+        enqueues: Optional[AsyncIOMotorCollection] = None,
+    ):
+        self.collection = collection
+        # stock_id -> время завершения постановки в очередь
+        self.enqueues = enqueues
+        self.dispatcher = dispatcher
+        self.dead_chats = dead_chats
+        self.senders = senders
+        self.batch_size = batch_size
+        self.owner = uuid.uuid4().hex
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=batch_size * 2)
+        self._wakeup = asyncio.Event()
+        self._done: List = []
+        self._retry: List = []
+        self._failed: List = []
+        self._skipped: List = []
+        self._tasks: List[asyncio.Task] = []
+        self._delivered_since_report = 0
+        # Доставки, взятые отправителями, но еще не завершенные
+        self._in_flight = 0
+        # _id забранных доставок до записи их результата: в очереди в памяти они могут
+        # пережить аренду (например, за паузой RetryAfter) и не должны забираться повторно
+        self._claimed: Set = set()
+        # stock_id -> время получения, время последней доставки и итоги рассылки
+        self._stock_reports: Dict[object, dict] = {}
+
+    async def create_indexes(self):
+        # Одно уведомление на пользователя для стока - повторная постановка не создает дублей
+        await self.collection.create_index([('stock_id', ASCENDING), ('chat_id', ASCENDING)], unique=True)
+        await self.collection.create_index([('status', ASCENDING), ('lease_until', ASCENDING)])
+        # finished_at есть только у записей в конечном статусе
+        await self.collection.create_index('finished_at', expireAfterSeconds=OUTBOX_RETENTION_SECONDS)
+        # Прежний TTL-индекс покрывал только доставленные записи
+        try:
+            await self.collection.drop_index('sent_at_1')
+        except OperationFailure:
+            pass
+        # Записи, завершенные до появления finished_at, иначе не удалятся никогда
+        await self.collection.update_many(
+            {'status': {'$in': [STATUS_DONE, STATUS_FAILED, STATUS_SKIPPED]}, 'finished_at': {'$exists': False}},
+            [{'$set': {'finished_at': {'$ifNull': ['$sent_at', '$created_at']}}}]
+        )
+        if self.enqueues is not None:
+            await self.enqueues.create_index('completed_at', expireAfterSeconds=OUTBOX_RETENTION_SECONDS)
+
+    async def start(self):
+        """Запуск задач разбора очереди"""
+        if self._tasks:
+            return
+        await self.recover()
+        self._tasks.append(asyncio.create_task(self._claim_loop()))
+        self._tasks.append(asyncio.create_task(self._flush_loop()))
+        for _ in range(self.senders):
+            self._tasks.append(asyncio.create_task(self._sender()))
+
+    async def recover(self) -> int:
+        """Вернуть в очередь доставки, оставшиеся в аренде после падения воркера"""
+        result = await self.collection.update_many(
+            {'status': STATUS_SENDING, 'owner': {'$ne': self.owner}},
+            {'$set': {'status': STATUS_PENDING, 'lease_until': datetime.now(timezone.utc)}, '$unset': {'owner': ''}}
+        )
+        if result.modified_count:
+            logger.info(f"♻️ Возвращено в очередь {result.modified_count} незавершенных доставок")
+        return result.modified_count
+
+    async def enqueue(self, stock_id, deliveries: Iterable[Tuple[int, str]]) -> int:
+        """Поставить доставки (chat_id, текст) в очередь. Возвращает число новых записей."""
+        now = datetime.now(timezone.utc)
+        inserted = 0
+        chunk = []
+        chunk_size = min(OUTBOX_FIRST_CHUNK_SIZE, self.batch_size)
+        # Доставки читаются лениво: в памяти не больше одной пачки
+        for chat_id, text in deliveries:
+            chunk.append({
+                'stock_id': stock_id,
+                'chat_id': chat_id,
+                'text': text,
+                'status': STATUS_PENDING,
+                'attempts': 0,
+                'created_at': now,
+                'lease_until': now,
+            })
+            if len(chunk) >= chunk_size:
+                inserted += await self._insert(chunk)
+                chunk = []
+                chunk_size = self.batch_size
+        if chunk:
+            inserted += await self._insert(chunk)
+        if self.enqueues is not None:
+            await self.enqueues.update_one(
+                {'_id': stock_id}, {'$set': {'completed_at': datetime.now(timezone.utc)}}, upsert=True
+            )
+        return inserted
+
+    async def needs_resume(self, stock: dict) -> bool:
+        """Постановка стока в очередь была прервана (например, падением воркера)"""
+        if self.enqueues is None:
+            return False
+        created_at = stock['created_at']
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        # Уведомление о давно сменившемся стоке уже бесполезно
+        if datetime.now(timezone.utc) - created_at > timedelta(seconds=OUTBOX_RESUME_MAX_AGE):
+            return False
+        return await self.enqueues.find_one({'_id': stock['_id']}, {'_id': 1}) is None
+
+    def track(self, stock_id, received_at: Optional[float]):
+        """Замерять время от получения стока (time.perf_counter()) до первой и последней доставки"""
+        self._stock_reports[stock_id] = {'received_at': received_at, 'last_sent': None, 'results': Counter()}
+
+    def _record_result(self, stock_id, result: str):
+        report = self._stock_reports.get(stock_id)
+        if report is None:
+            # Доставки, оставшиеся после перезапуска: время получения стока неизвестно
+            self.track(stock_id, None)
+            report = self._stock_reports[stock_id]
+        report['results'][result] += 1
+        if result != STATUS_DONE:
+            return
+        now = time.perf_counter()
+        if report['last_sent'] is None and report['received_at'] is not None:
+            NOTIFICATION_FIRST_SECONDS.observe(now - report['received_at'], source='discord')
+        report['last_sent'] = now
+
+    def _finish_reports(self):
+        """Очередь разобрана - по каждому стоку пишем одну итоговую запись"""
+        for stock_id, report in self._stock_reports.items():
+            received_at, last_sent = report['received_at'], report['last_sent']
+            if received_at is not None and last_sent is not None:
+                duration = last_sent - received_at
+                NOTIFICATION_LAST_SECONDS.observe(duration, source='discord')
+                logger.info(f"📊 Рассылка стока {stock_id} завершена за {duration:.2f} с: {dict(report['results'])}")
+            else:
+                logger.info(f"📊 Рассылка стока {stock_id} завершена: {dict(report['results'])}")
+        self._stock_reports = {}
+
+    async def _insert(self, docs: List[dict]) -> int:
+        delay = OUTBOX_INSERT_RETRY_DELAY
+        for attempt in range(OUTBOX_INSERT_RETRIES + 1):
+            try:
+                result = await self.collection.insert_many(docs, ordered=False)
+                inserted = len(result.inserted_ids)
+                break
+            except BulkWriteError as e:
+                # Дубликаты (сток уже ставился в очередь или пачка повторяется) пропускаем
+                inserted = e.details.get('nInserted', 0)
+                break
+            except ConnectionFailure as e:
+                if attempt == OUTBOX_INSERT_RETRIES:
+                    raise
+                logger.warning(f"⚠️ Ошибка записи пачки уведомлений ({e}), повтор через {delay:.0f} с")
+                await asyncio.sleep(delay)
+                delay *= 2
+        # Отправители начинают работу сразу после первой пачки, не дожидаясь остальных
+        if inserted:
+            self._wakeup.set()
+        return inserted
+
+    async def _claim_batch(self) -> List[dict]:
+        """Забрать пачку доставок в аренду"""
+        now = datetime.now(timezone.utc)
+        available = {
+            'status': {'$in': [STATUS_PENDING, STATUS_SENDING]},
+            'lease_until': {'$lte': now},
+        }
+        query = {**available, '_id': {'$nin': list(self._claimed)}} if self._claimed else available
+        candidates = await self.collection.find(query, {'_id': 1}) \
+            .sort('lease_until', ASCENDING).limit(self.batch_size).to_list(length=self.batch_size)
+        if not candidates:
+            return []
+
+        ids = [doc['_id'] for doc in candidates]
+        lease_until = now + timedelta(seconds=OUTBOX_LEASE_SECONDS)
+        await self.collection.update_many(
+            {'_id': {'$in': ids}, **available},
+            {'$set': {'status': STATUS_SENDING, 'lease_until': lease_until, 'owner': self.owner}}
+        )
+        batch = await self.collection.find(
+            {'_id': {'$in': ids}, 'owner': self.owner, 'status': STATUS_SENDING, 'lease_until': lease_until},
+            {'stock_id': 1, 'chat_id': 1, 'text': 1, 'attempts': 1}
+        ).to_list(length=self.batch_size)
+        self._claimed.update(doc['_id'] for doc in batch)
+        return batch
+
+    async def _claim_loop(self):
+        while True:
+            try:
+                batch = await self._claim_batch()
+            except PyMongoError as e:
+                logger.error(f"❌ Ошибка чтения очереди уведомлений: {e}")
+                batch = []
+
+            if not batch:
+                if self._stock_reports and self._queue.empty() and not self._in_flight:
+                    self._finish_reports()
+                if self._delivered_since_report and self._queue.empty():
+                    logger.info(f"📊 Очередь уведомлений разобрана, статистика доставки: {self.dispatcher.stats.reset()}")
+                    self._delivered_since_report = 0
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=OUTBOX_IDLE_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            for doc in batch:
+                await self._queue.put(doc)
+
+    async def _sender(self):
+        while True:
+            doc = await self._queue.get()
+            chat_id = doc['chat_id']
+            self._in_flight += 1
+            try:
+                if self.dead_chats is not None and chat_id in self.dead_chats:
+                    # Бот заблокирован - не тратим на чат запрос и место в лимите
+                    self.dead_chats.record_skipped()
+                    self._skipped.append(doc['_id'])
+                    self._record_result(doc.get('stock_id'), STATUS_SKIPPED)
+                    continue
+                await self.dispatcher.send_message(
+                    chat_id,
+                    doc['text'],
+                    lane=LANE_BULK,
+                    parse_mode='HTML',
+                    disable_web_page_preview=True
+                )
+                self._done.append(doc['_id'])
+                self._record_result(doc.get('stock_id'), STATUS_DONE)
+                # Строки по отдельным пользователям прореживаются, итог - в записи по стоку
+                logger.debug("Уведомление доставлено пользователю %s", chat_id, extra=SAMPLED)
+            except Exception as e:
+                kind = classify_error(e)
+                if kind == ERROR_RETRYABLE:
+                    # Временная ошибка - попробуем еще раз
+                    self._retry.append(doc['_id'])
+                    result = 'retry'
+                elif kind == ERROR_DEAD_CHAT:
+                    if self.dead_chats is not None:
+                        self.dead_chats.mark_dead(chat_id)
+                    self._skipped.append(doc['_id'])
+                    result = STATUS_SKIPPED
+                else:
+                    self._failed.append(doc['_id'])
+                    result = STATUS_FAILED
+                self._record_result(doc.get('stock_id'), result)
+                logger.debug("Ошибка отправки пользователю %s: %r", chat_id, e, extra=SAMPLED)
+            finally:
+                self._in_flight -= 1
+                self._queue.task_done()
+
+    async def flush(self):
+        """Записать результаты доставок в базу пачками"""
+        done, self._done = self._done, []
+        retry, self._retry = self._retry, []
+        failed, self._failed = self._failed, []
+        skipped, self._skipped = self._skipped, []
+        now = datetime.now(timezone.utc)
+
+        try:
+            if done:
+                await self.collection.update_many(
+                    {'_id': {'$in': done}},
+                    {'$set': {'status': STATUS_DONE, 'sent_at': now, 'finished_at': now}, '$unset': {'owner': ''}}
+                )
+                self._delivered_since_report += len(done)
+                self._claimed.difference_update(done)
+                done = []
+            if failed:
+                await self.collection.update_many(
+                    {'_id': {'$in': failed}},
+                    {'$set': {'status': STATUS_FAILED, 'finished_at': now}, '$unset': {'owner': ''}}
+                )
+                self._claimed.difference_update(failed)
+                failed = []
+            if skipped:
+                await self.collection.update_many(
+                    {'_id': {'$in': skipped}},
+                    {'$set': {'status': STATUS_SKIPPED, 'finished_at': now}, '$unset': {'owner': ''}}
+                )
+                self._claimed.difference_update(skipped)
+                skipped = []
+            if retry:
+                # Одним обновлением: повтор записи после сбоя не увеличит attempts дважды
+                await self.collection.update_many(
+                    {'_id': {'$in': retry}},
+                    [
+                        {'$set': {'attempts': {'$add': [{'$ifNull': ['$attempts', 0]}, 1]}, 'lease_until': now}},
+                        {'$set': {'status': {'$cond': [
+                            {'$gte': ['$attempts', OUTBOX_MAX_ATTEMPTS]}, STATUS_FAILED, STATUS_PENDING
+                        ]}}},
+                        {'$set': {'finished_at': {'$cond': [
+                            {'$eq': ['$status', STATUS_FAILED]}, now, '$$REMOVE'
+                        ]}}},
+                        {'$unset': 'owner'},
+                    ]
+                )
+                self._claimed.difference_update(retry)
+                retry = []
+                self._wakeup.set()
+        except PyMongoError:
+            # Не теряем ни одну отметку - иначе после истечения аренды будут дубли
+            self._done.extend(done)
+            self._retry.extend(retry)
+            self._failed.extend(failed)
+            self._skipped.extend(skipped)
+            raise
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(OUTBOX_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except PyMongoError as e:
+                logger.error(f"❌ Ошибка записи статусов доставки: {e}")
@@ -1,41 +1,49 @@
 import asyncio
+import hashlib
+import json
 import os
 import logging
+import re
+import time
 from datetime import datetime, timezone
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 import aiohttp
 from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateMany, UpdateOne
 from telegram import Bot
-from telegram.error import TelegramError
 from dotenv import load_dotenv
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 from mongo_init import get_db
+from app.common.indexes import bootstrap_indexes
+from app.common.logging_setup import SAMPLED, setup_logging
+from app.common.metrics import (
+    NOTIFICATION_FIRST_SECONDS, NOTIFICATION_LAST_SECONDS, STOCK_INSERT_SECONDS, STOCK_PARSE_SECONDS,
+    start_metrics_server
+)
+from app.common.notification_render import StockNotificationRenderer
+from app.common.telegram_dispatcher import ERROR_DEAD_CHAT, TelegramDispatcher, classify_error
 
 # Загружаем переменные окружения
 load_dotenv()
 
-# Настройка логирования
-log_handlers = [logging.StreamHandler()]
-
-# Пытаемся добавить файловый обработчик
-try:
-    os.makedirs('/app/logs', exist_ok=True)
-    log_handlers.append(logging.FileHandler('/app/logs/parser_worker.log', encoding='utf-8'))
-except (PermissionError, OSError) as e:
-    print(f"Warning: Cannot create log file: {e}. Using console output only.")
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=log_handlers
-)
+# Логи пишутся в stdout и /app/logs/parser_worker.log фоновым потоком (см. main)
 logger = logging.getLogger(__name__)
 
 # URL API
 API_URL = "https://plantsvsbrainrots.com/api/latest-message"
 REQUEST_INTERVAL = 5  # секунды
 
+# Сколько уведомлений отправлять одновременно и размер батча курсора подписчиков
+NOTIFICATION_CONCURRENCY = int(os.getenv('NOTIFICATION_CONCURRENCY', '30'))
+SUBSCRIBERS_BATCH_SIZE = 1000
+
+# Адаптивный опрос: часто около границы ротации стока, редко между ними
+MIN_REQUEST_INTERVAL = float(os.getenv('MIN_REQUEST_INTERVAL', '1'))
+MAX_REQUEST_INTERVAL = float(os.getenv('MAX_REQUEST_INTERVAL', '30'))
+STOCK_ROTATION_PERIOD = int(os.getenv('STOCK_ROTATION_PERIOD', '300'))  # сток меняется каждые 5 минут
+STOCK_ROTATION_WINDOW = int(os.getenv('STOCK_ROTATION_WINDOW', '30'))   # сколько секунд после границы ждем новый сток
+
 
 class StockParser:
     def __init__(self):
@@ -44,6 +52,21 @@ class StockParser:
         self.subscriptions_collection = None
         self.session: aiohttp.ClientSession = None
         self.bot: Bot = None
+        self.dispatcher: TelegramDispatcher = None
+        
+        # Состояние условных запросов к API
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.content_hash: Optional[str] = None
+        # Валидаторы последнего ответа, принимаются только после успешной обработки
+        self.fetched_validators: Optional[tuple] = None
+        # Номер ротации, в которой уже видели новый сток, и текущий интервал простоя
+        self.seen_rotation: Optional[int] = None
+        self.idle_interval = REQUEST_INTERVAL
+        # (id стока, шаблон уведомлений) для последнего отправляемого стока
+        self.notification_renderer = None
+        # Эндпоинт /metrics (запускается в main)
+        self.metrics_task: Optional[asyncio.Task] = None
         
         # Маппинг названий растений для поиска
         self.plant_mapping = {
@@ -61,6 +84,17 @@ class StockParser:
             "starfruit": ["starfruit", "🌟"]
         }
         
+        # Все ключевые слова в одном регулярном выражении: каждое поле стока сканируется один раз.
+        # Длинные слова идут первыми, чтобы 'dragon fruit' и '🌶️' не обрезались до 'dragon' и '🌶'
+        self.keyword_plants = {
+            keyword.lower(): plant_id
+            for plant_id, keywords in self.plant_mapping.items()
+            for keyword in keywords
+        }
+        self.plant_pattern = re.compile('|'.join(
+            re.escape(keyword) for keyword in sorted(self.keyword_plants, key=len, reverse=True)
+        ))
+        
     async def init(self):
         """Инициализация подключений"""
         self.db = get_db()
@@ -72,6 +106,7 @@ class StockParser:
         bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
         if bot_token:
             self.bot = Bot(token=bot_token)
+            self.dispatcher = TelegramDispatcher(self.bot)
             logger.info("Telegram bot initialized for notifications")
         else:
             logger.warning("TELEGRAM_BOT_TOKEN not set, notifications disabled")
@@ -83,47 +118,79 @@ class StockParser:
         if self.session:
             await self.session.close()
             
-    async def fetch_stocks(self) -> List[Dict[str, Any]]:
-        """Получение данных с API"""
+    async def fetch_stocks(self) -> Optional[List[Dict[str, Any]]]:
+        """Получение данных с API.
+
+        Возвращает None, если ответ не изменился с прошлого запроса
+        (304 Not Modified или тот же хэш содержимого).
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        
         try:
-            async with self.session.get(API_URL, timeout=10) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    logger.info(f"Fetched {len(data)} stock updates")
-                    return data
-                else:
+            async with self.session.get(API_URL, headers=headers, timeout=10) as response:
+                if response.status == 304:
+                    return None
+                if response.status != 200:
                     logger.error(f"API returned status {response.status}")
                     return []
+                
+                body = await response.read()
+                etag = response.headers.get('ETag')
+                last_modified = response.headers.get('Last-Modified')
         except Exception as e:
             logger.error(f"Error fetching stocks: {e}")
             return []
+        
+        # Сервер может не поддерживать условные запросы - сравниваем содержимое
+        content_hash = hashlib.sha256(body).hexdigest()
+        if content_hash == self.content_hash:
+            return None
+        
+        data = json.loads(body)
+        self.fetched_validators = (etag, last_modified, content_hash)
+        logger.info(f"Fetched {len(data)} stock updates")
+        return data
+    
+    def commit_fetch(self):
+        """Запомнить обработанный ответ - следующие такие же ответы будут пропущены"""
+        if self.fetched_validators:
+            self.etag, self.last_modified, self.content_hash = self.fetched_validators
+            self.fetched_validators = None
+    
+    def next_poll_delay(self, changed: bool) -> float:
+        """Пауза до следующего запроса.
+
+        В начале каждой ротации, пока новый сток не получен, опрашиваем часто.
+        Между ротациями интервал растет до MAX_REQUEST_INTERVAL, но следующий
+        запрос никогда не откладывается дальше границы ротации.
+        """
+        now = time.time()
+        rotation = int(now // STOCK_ROTATION_PERIOD)
+        since_boundary = now - rotation * STOCK_ROTATION_PERIOD
+        until_boundary = STOCK_ROTATION_PERIOD - since_boundary
+        
+        if changed:
+            self.seen_rotation = rotation
+            self.idle_interval = REQUEST_INTERVAL
+        
+        if since_boundary < STOCK_ROTATION_WINDOW and self.seen_rotation != rotation:
+            return MIN_REQUEST_INTERVAL
+        
+        if not changed:
+            self.idle_interval = min(MAX_REQUEST_INTERVAL, self.idle_interval * 2)
+        return max(MIN_REQUEST_INTERVAL, min(self.idle_interval, until_boundary))
             
-    async def process_stock(self, stock_data: Dict[str, Any], is_active: bool = False):
-        """Обработка и сохранение одного стока"""
-        stock_id = stock_data.get('id')
-        if not stock_id:
-            logger.warning("Stock without ID skipped")
-            return
-            
-        # Проверяем существование стока
-        existing_stock = await self.collection.find_one({'id': stock_id})
-        if existing_stock:
-            # Если сток уже существует, обновляем только флаг active если нужно
-            if is_active and not existing_stock.get('active', False):
-                await self.collection.update_one(
-                    {'id': stock_id},
-                    {'$set': {'active': True}}
-                )
-                logger.info(f"Updated stock {stock_id} as active")
-            return
-            
-        # Подготавливаем данные для сохранения
+    def build_stock_document(self, stock_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Подготовка документа стока для сохранения (без флага active)"""
         stock_document = {
-            'id': stock_id,
+            'id': stock_data.get('id'),
             'content': stock_data.get('content', ''),
             'createdAt': stock_data.get('createdAt'),
             'embeds': stock_data.get('embeds', []),
-            'active': is_active,
             'parsed_at': datetime.now(timezone.utc)
         }
         
@@ -156,17 +223,65 @@ class StockParser:
         })
         
         stock_document['plants_data'] = plants_data
+        stock_document['plant_fields'] = self.match_plant_fields(plants_data)
+        return stock_document
+    
+    async def process_stocks(self, stocks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Сохранение всего ответа API одним bulk_write.
+
+        Первый элемент - текущий активный сток. Новые стоки вставляются
+        upsert-ом по id, флаг active переключается в том же запросе.
+        Возвращает документы стоков, которых раньше не было в базе.
+        """
+        operations = []
+        documents = []
+        active_id = None
+        parse_started = time.perf_counter()
+        
+        for index, stock_data in enumerate(stocks):
+            stock_id = stock_data.get('id')
+            if not stock_id:
+                logger.warning("Stock without ID skipped")
+                continue
+            
+            is_active = (index == 0)
+            if is_active:
+                active_id = stock_id
+            
+            stock_document = self.build_stock_document(stock_data)
+            operations.append(UpdateOne(
+                {'id': stock_id},
+                {'$setOnInsert': stock_document, '$set': {'active': is_active}},
+                upsert=True
+            ))
+            documents.append({**stock_document, 'active': is_active})
         
-        # Сохраняем в базу
-        await self.collection.insert_one(stock_document)
-        logger.info(f"Saved new stock {stock_id} (active={is_active})")
+        STOCK_PARSE_SECONDS.observe(time.perf_counter() - parse_started, source='api')
+        if not operations:
+            return []
         
-        # Если это новый активный сток и есть бот, отправляем уведомления
-        if is_active and self.bot:
-            await self.send_plant_notifications(stock_document)
+        # Деактивируем все старые активные стоки в том же запросе
+        operations.append(UpdateMany(
+            {'active': True, 'id': {'$ne': active_id}},
+            {'$set': {'active': False}}
+        ))
+        
+        with STOCK_INSERT_SECONDS.time(source='api'):
+            result = await self.collection.bulk_write(operations, ordered=False)
+        
+        new_stocks = []
+        for index, inserted_id in result.upserted_ids.items():
+            stock_document = documents[index]
+            stock_document['_id'] = inserted_id
+            new_stocks.append(stock_document)
+            logger.info(f"Saved new stock {stock_document['id']} (active={stock_document['active']})")
+        
+        return new_stocks
     
     async def send_plant_notifications(self, stock: Dict[str, Any]):
         """Отправка уведомлений пользователям о растениях в стоке"""
+        started = time.perf_counter()
+        last_sent = None
         # Получаем все растения из стока
         plants_in_stock = self.extract_plants_from_stock(stock)
         
@@ -176,67 +291,94 @@ class StockParser:
         
         logger.info(f"Plants in stock: {plants_in_stock}")
         
-        # Получаем всех пользователей с подписками
-        subscribers = await self.subscriptions_collection.find({'plants': {'$exists': True, '$ne': []}}).to_list(length=None)
-        
-        if not subscribers:
-            logger.info("No subscribers found")
-            return
-        
-        # Для каждого подписчика проверяем, есть ли его растения в стоке
+        # Пул отправителей читает подписчиков из ограниченной очереди
+        queue: asyncio.Queue = asyncio.Queue(maxsize=NOTIFICATION_CONCURRENCY * 2)
+        blocked_users = []
         notifications_sent = 0
-        for subscriber in subscribers:
-            user_id = subscriber.get('user_id')
-            subscribed_plants = subscriber.get('plants', [])
-            
-            if not user_id or not subscribed_plants:
-                continue
-            
-            # Находим пересечение подписок и растений в стоке
-            matched_plants = [plant for plant in subscribed_plants if plant in plants_in_stock]
-            
-            if matched_plants:
-                # Формируем и отправляем уведомление
+        
+        async def sender():
+            nonlocal notifications_sent, last_sent
+            while True:
+                subscriber = await queue.get()
+                if subscriber is None:
+                    return
+                
+                user_id = subscriber['user_id']
+                # Находим пересечение подписок и растений в стоке
+                matched_plants = [plant for plant in subscriber.get('plants', []) if plant in plants_in_stock]
+                if not matched_plants:
+                    continue
                 message = self.format_plant_notification(stock, matched_plants, plants_in_stock)
                 
                 try:
-                    await self.bot.send_message(
-                        chat_id=user_id,
-                        text=message,
+                    await self.dispatcher.send_message(
+                        user_id,
+                        message,
                         parse_mode='HTML'
                     )
+                    last_sent = time.perf_counter()
+                    if not notifications_sent:
+                        NOTIFICATION_FIRST_SECONDS.observe(last_sent - started, source='api')
                     notifications_sent += 1
-                    logger.info(f"Sent notification to user {user_id} about plants: {matched_plants}")
-                except TelegramError as e:
-                    logger.error(f"Failed to send notification to user {user_id}: {e}")
-                    
-                    # Если пользователь заблокировал бота, удаляем его подписки
-                    if "blocked" in str(e).lower() or "user not found" in str(e).lower():
-                        await self.subscriptions_collection.delete_one({'user_id': user_id})
-                        logger.info(f"Removed subscriptions for blocked user {user_id}")
+                    logger.debug("Sent notification to user %s about plants: %s", user_id, matched_plants, extra=SAMPLED)
+                except Exception as e:
+                    # Отправитель не должен падать, иначе пул остановится
+                    if classify_error(e) == ERROR_DEAD_CHAT:
+                        # Пользователь заблокировал бота - удалим его подписки после рассылки
+                        logger.debug("User %s blocked the bot: %s", user_id, e, extra=SAMPLED)
+                        blocked_users.append(user_id)
+                    else:
+                        logger.error(f"Failed to send notification to user {user_id}: {e}")
         
-        logger.info(f"Sent {notifications_sent} plant notifications")
+        senders = [asyncio.create_task(sender()) for _ in range(NOTIFICATION_CONCURRENCY)]
+        
+        # Читаем из курсора только подписчиков, у которых есть растения из стока
+        cursor = self.subscriptions_collection.find(
+            {'plants': {'$in': plants_in_stock}},
+            {'user_id': 1, 'plants': 1},
+            batch_size=SUBSCRIBERS_BATCH_SIZE
+        )
+        try:
+            async for subscriber in cursor:
+                if subscriber.get('user_id'):
+                    await queue.put(subscriber)
+        finally:
+            for _ in senders:
+                await queue.put(None)
+            await asyncio.gather(*senders)
+        
+        # Подписки заблокировавших бота пользователей удаляем одним запросом
+        if blocked_users:
+            await self.subscriptions_collection.delete_many({'user_id': {'$in': blocked_users}})
+            logger.info(f"Removed subscriptions for {len(blocked_users)} blocked users")
+        
+        if last_sent is not None:
+            NOTIFICATION_LAST_SECONDS.observe(last_sent - started, source='api')
+        logger.info(f"Sent {notifications_sent} plant notifications, delivery stats: {self.dispatcher.stats.reset()}")
+    
+    def match_plant_fields(self, plants_data: List[Dict[str, Any]]) -> Dict[str, int]:
+        """Растение -> индекс первого поля plants_data, где оно упоминается"""
+        plant_fields = {}
+        for index, plant_info in enumerate(plants_data):
+            plant_name = plant_info.get('name', '').lower()
+            for match in self.plant_pattern.finditer(plant_name):
+                plant_fields.setdefault(self.keyword_plants[match.group()], index)
+        return plant_fields
+    
+    def get_plant_fields(self, stock: Dict[str, Any]) -> Dict[str, int]:
+        """Сопоставление растений полям стока (считается один раз и хранится в документе)"""
+        plant_fields = stock.get('plant_fields')
+        if plant_fields is None:
+            plant_fields = self.match_plant_fields(stock.get('plants_data', []))
+            stock['plant_fields'] = plant_fields
+        return plant_fields
     
     def extract_plants_from_stock(self, stock: Dict[str, Any]) -> List[str]:
         """Извлечь список растений из стока"""
-        found_plants = set()
-        
-        # Проверяем plants_data
-        plants_data = stock.get('plants_data', [])
-        for plant_info in plants_data:
-            plant_name = plant_info.get('name', '').lower()
-            
-            # Проверяем каждое известное растение
-            for plant_id, keywords in self.plant_mapping.items():
-                for keyword in keywords:
-                    if keyword.lower() in plant_name:
-                        found_plants.add(plant_id)
-                        break
-        
-        return list(found_plants)
+        return list(self.get_plant_fields(stock))
     
-    def format_plant_notification(self, stock: Dict[str, Any], matched_plants: List[str], all_plants: List[str]) -> str:
-        """Форматировать уведомление о растениях"""
+    def build_notification_renderer(self, stock: Dict[str, Any]) -> StockNotificationRenderer:
+        """Шаблон уведомлений о растениях: шапка, строки растений и весь сток строятся один раз"""
         # Получаем информацию о растениях
         plant_emojis = {
             'sunflower': '🌻',
@@ -252,7 +394,7 @@ class StockParser:
             'mango': '🥭'
         }
         
-        message_parts = ["🎯 <b>ВАШИ РАСТЕНИЯ В СТОКЕ!</b>\n"]
+        header_parts = ["🎯 <b>ВАШИ РАСТЕНИЯ В СТОКЕ!</b>\n"]
         
         # Дата
         created_at = stock.get('createdAt', '')
@@ -260,69 +402,73 @@ class StockParser:
             try:
                 dt = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
                 formatted_date = dt.strftime('%d.%m.%Y %H:%M UTC')
-                message_parts.append(f"📅 {formatted_date}\n")
+                header_parts.append(f"📅 {formatted_date}\n")
             except:
                 pass
         
-        # Показываем растения, на которые подписан пользователь
-        message_parts.append("<b>Ваши растения:</b>")
-        for plant_id in matched_plants:
+        # Растения, на которые подписан пользователь, выбираются из этих строк
+        header_parts.append("<b>Ваши растения:</b>")
+        plants_data = stock.get('plants_data', [])
+        plant_lines = {}
+        for plant_id, index in self.get_plant_fields(stock).items():
             emoji = plant_emojis.get(plant_id, '🌱')
-            # Находим информацию о стоке для этого растения
-            plants_data = stock.get('plants_data', [])
-            for plant_info in plants_data:
-                plant_name = plant_info.get('name', '').lower()
-                if any(keyword.lower() in plant_name for keyword in self.plant_mapping.get(plant_id, [])):
-                    value = plant_info.get('value', '')
-                    message_parts.append(f"{emoji} {plant_info.get('name', '')}: <b>{value}</b>")
-                    break
-        
-        message_parts.append("\n<b>Весь сток:</b>")
+            plant_info = plants_data[index]
+            value = plant_info.get('value', '')
+            plant_lines[plant_id] = f"{emoji} {plant_info.get('name', '')}: <b>{value}</b>"
+        
+        footer_parts = ["\n<b>Весь сток:</b>"]
         # Показываем все растения в стоке
-        plants_data = stock.get('plants_data', [])
         for plant_info in plants_data:
             name = plant_info.get('name', '')
             value = plant_info.get('value', '')
-            message_parts.append(f"{name}: {value}")
+            footer_parts.append(f"{name}: {value}")
         
-        return "\n".join(message_parts)
-            
-    async def deactivate_old_stocks(self):
-        """Деактивация всех старых активных стоков"""
-        result = await self.collection.update_many(
-            {'active': True},
-            {'$set': {'active': False}}
+        return StockNotificationRenderer(
+            "\n".join(header_parts) + "\n",
+            plant_lines,
+            "\n" + "\n".join(footer_parts)
         )
-        if result.modified_count > 0:
-            logger.info(f"Deactivated {result.modified_count} old active stocks")
-            
+    
+    def format_plant_notification(self, stock: Dict[str, Any], matched_plants: List[str], all_plants: List[str]) -> str:
+        """Форматировать уведомление о растениях (шаблон строится один раз на сток)"""
+        stock_key = stock.get('id')
+        if self.notification_renderer is None or self.notification_renderer[0] != stock_key:
+            self.notification_renderer = (stock_key, self.build_notification_renderer(stock))
+        return self.notification_renderer[1].render(matched_plants)
+    
     async def run_parser(self):
         """Основной цикл парсера"""
         while True:
+            changed = False
             try:
-                # Получаем данные с API
+                # Получаем данные с API (None - ответ не изменился, база не нужна)
                 stocks = await self.fetch_stocks()
+                changed = bool(stocks)
                 
                 if stocks:
-                    # Сначала деактивируем все старые активные стоки
-                    await self.deactivate_old_stocks()
+                    # Сохраняем все стоки одним запросом
+                    new_stocks = await self.process_stocks(stocks)
+                    self.commit_fetch()
                     
-                    # Обрабатываем стоки
-                    for index, stock in enumerate(stocks):
-                        # Первый элемент - текущий активный сток
-                        is_active = (index == 0)
-                        await self.process_stock(stock, is_active)
+                    # Уведомления только для нового активного стока
+                    if self.bot:
+                        for stock_document in new_stocks:
+                            if stock_document['active']:
+                                await self.send_plant_notifications(stock_document)
                         
-                logger.info(f"Parser cycle completed. Next run in {REQUEST_INTERVAL} seconds")
-                
             except Exception as e:
                 logger.error(f"Error in parser cycle: {e}")
                 
             # Ждем перед следующим запросом
-            await asyncio.sleep(REQUEST_INTERVAL)
+            delay = self.next_poll_delay(changed)
+            logger.debug(f"Parser cycle completed (changed={changed}). Next run in {delay:.1f} seconds")
+            await asyncio.sleep(delay)
             
     async def create_indexes(self):
         """Создание индексов для оптимизации"""
+        # Общие коллекции (stocks, plant_subscriptions, users)
+        await bootstrap_indexes(self.db)
+        
         # Индекс по id для быстрого поиска
         await self.collection.create_index('id', unique=True)
         # Индекс по active для быстрого поиска активных стоков
@@ -339,6 +485,7 @@ class StockParser:
 
 async def main():
     """Главная функция"""
+    setup_logging('parser_worker')
     parser = StockParser()
     
     try:
@@ -348,6 +495,8 @@ async def main():
         # Создаем индексы
         await parser.create_indexes()
         
+        parser.metrics_task = await start_metrics_server()
+        
         # Запускаем парсер
         logger.info("Starting stock parser...")
         await parser.run_parser()
@@ -0,0 +1,152 @@
+"""Разбор embed-сообщений 'PVB Stock Alerts' со стоком.
+
+Строка стока выглядит как ``<:cactus:123> **Cactus** **x4**``: кастомные
+эмодзи Discord, название и количество после ``x``.
+
+Бенчмарк на записанных payload (по одному embed.to_dict() в строке JSON)::
+
+    python -m app.workers.stock_embed_parser corpus.jsonl --iterations 1000
+"""
+import argparse
+import json
+import os
+import re
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Кастомные эмодзи Discord: <:name:id> и анимированные <a:name:id>
+EMOJI_RE = re.compile(r'<a?:\w+:\d+>')
+# Название и количество: 'Cactus x4', 'Mr Carrot x12'
+STOCK_LINE_RE = re.compile(r'^(?P<name>.+?)\s*[xх×]\s*(?P<quantity>\d+)$', re.IGNORECASE)
+
+# Файл, в который on_message дописывает сырые embed для корпуса бенчмарка
+STOCK_EMBED_CORPUS_PATH = os.getenv('STOCK_EMBED_CORPUS_PATH')
+
+
+class StockParseResult:
+    """Результат разбора embed со стоком"""
+
+    def __init__(self):
+        self.seeds_stock: Dict[str, int] = {}
+        self.gear_stock: Dict[str, int] = {}
+        # Строки, которые не удалось разобрать
+        self.errors: List[str] = []
+
+    def __bool__(self) -> bool:
+        return bool(self.seeds_stock or self.gear_stock)
+
+
+def parse_stock_line(line: str) -> Optional[Tuple[str, int]]:
+    """Разобрать одну строку стока в (название, количество)"""
+    text = EMOJI_RE.sub('', line).replace('*', '').strip()
+    match = STOCK_LINE_RE.match(text)
+    if not match:
+        return None
+    return match.group('name').strip(), int(match.group('quantity'))
+
+
+def parse_stock_value(value: str, target: Dict[str, int], errors: List[str]):
+    for line in value.split('\n'):
+        if not line.strip():
+            continue
+        parsed = parse_stock_line(line)
+        if parsed is None:
+            errors.append(line)
+            continue
+        name, quantity = parsed
+        target[name] = quantity
+
+
+def embed_fields(embed) -> List[Tuple[str, str]]:
+    """Поля embed как (name, value) - для discord.Embed и для словаря из to_dict()"""
+    if isinstance(embed, dict):
+        return [(field.get('name') or '', field.get('value') or '') for field in embed.get('fields', [])]
+    return [(field.name or '', field.value or '') for field in embed.fields]
+
+
+def parse_stock_fields(fields: Iterable[Tuple[str, str]]) -> StockParseResult:
+    """Разобрать поля embed: семена и снаряжение.
+
+    Секция определяется по названию поля, а если оно не подсказывает -
+    по позиции (первое поле - семена, второе - снаряжение).
+    """
+    result = StockParseResult()
+    for position, (name, value) in enumerate(fields):
+        lowered = name.lower()
+        if 'seed' in lowered or 'семен' in lowered:
+            target = result.seeds_stock
+        elif 'gear' in lowered or 'снаряж' in lowered:
+            target = result.gear_stock
+        elif position == 0:
+            target = result.seeds_stock
+        elif position == 1:
+            target = result.gear_stock
+        else:
+            result.errors.append(f"{name}: {value}")
+            continue
+        parse_stock_value(value, target, result.errors)
+    return result
+
+
+def parse_stock_embed(embed) -> StockParseResult:
+    """Разобрать embed со стоком"""
+    return parse_stock_fields(embed_fields(embed))
+
+
+def record_embed(embed, path: str = STOCK_EMBED_CORPUS_PATH):
+    """Дописать сырой embed в корпус для бенчмарка"""
+    if not path:
+        return
+    payload = embed if isinstance(embed, dict) else embed.to_dict()
+    with open(path, 'a', encoding='utf-8') as corpus:
+        corpus.write(json.dumps(payload, ensure_ascii=False) + '\n')
+
+
+def load_corpus(path: str) -> List[dict]:
+    with open(path, encoding='utf-8') as corpus:
+        return [json.loads(line) for line in corpus if line.strip()]
+
+
+def benchmark(corpus: List[dict], iterations: int) -> dict:
+    """Проверить разбор всего корпуса и замерить скорость"""
+    failures = []
+    for number, payload in enumerate(corpus, 1):
+        result = parse_stock_embed(payload)
+        if result.errors or not result:
+            failures.append((number, result.errors))
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for payload in corpus:
+            parse_stock_embed(payload)
+    elapsed = time.perf_counter() - start
+
+    parsed = iterations * len(corpus)
+    return {
+        'payloads': len(corpus),
+        'failures': failures,
+        'parsed': parsed,
+        'seconds': elapsed,
+        'us_per_embed': elapsed / parsed * 1e6 if parsed else 0.0,
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Бенчмарк разбора embed со стоком")
+    arg_parser.add_argument('corpus', help="JSONL-файл с embed.to_dict() по одному в строке")
+    arg_parser.add_argument('--iterations', type=int, default=1000)
+    args = arg_parser.parse_args()
+
+    report = benchmark(load_corpus(args.corpus), args.iterations)
+    for number, errors in report['failures']:
+        print(f"❌ payload #{number}: неразобранные строки {errors}")
+    print(
+        f"📦 {report['payloads']} payload, {report['parsed']} разборов за {report['seconds']:.3f} с "
+        f"({report['us_per_embed']:.1f} мкс на embed), ошибок: {len(report['failures'])}"
+    )
+    if report['failures']:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import OperationFailure, PyMongoError
+
+from app.common.items import item_key
+
+logger = logging.getLogger(__name__)
+
+# Сколько стоков держать в горячей коллекции stocks до переноса в архив
+STOCK_HOT_RETENTION_HOURS = float(os.getenv('STOCK_HOT_RETENTION_HOURS', '48'))
+# Через сколько после переноса в архив сырой сток удаляется TTL-индексом
+STOCK_RAW_TTL_SECONDS = int(os.getenv('STOCK_RAW_TTL_SECONDS', '3600'))
+# Сколько хранить дневные бакеты архива (0 - бессрочно)
+STOCK_ARCHIVE_TTL_DAYS = int(os.getenv('STOCK_ARCHIVE_TTL_DAYS', '365'))
+# Как часто переносить стоки в архив
+STOCK_ARCHIVE_INTERVAL = float(os.getenv('STOCK_ARCHIVE_INTERVAL', '3600'))
+STOCK_ARCHIVE_BATCH_SIZE = 1000
+
+# Код ошибки MongoDB: индекс с теми же ключами, но другими опциями
+INDEX_OPTIONS_CONFLICT = 85
+
+
+def day_start(moment: datetime) -> datetime:
+    return datetime(moment.year, moment.month, moment.day)
+
+
+class StockRetention:
+    """Перенос старых стоков из stocks в дневные бакеты stock_archive.
+
+    В горячей коллекции остаются стоки за последние STOCK_HOT_RETENTION_HOURS.
+    Более старые дописываются в документ своего дня (сами стоки и счетчики
+    появлений предметов), помечаются archived_at и удаляются TTL-индексом -
+    сток не может пропасть, не попав в архив. Размер stocks и ее индексов
+    не зависит от того, сколько времени работает бот.
+    """
+
+    def __init__(self, stocks: AsyncIOMotorCollection, archive: AsyncIOMotorCollection):
+        self.stocks = stocks
+        self.archive = archive
+        self._task = None
+
+    async def create_indexes(self):
+        await self._ensure_ttl(
+            self.stocks, 'archived_at', STOCK_RAW_TTL_SECONDS,
+            partialFilterExpression={'archived_at': {'$exists': True}}
+        )
+        if STOCK_ARCHIVE_TTL_DAYS > 0:
+            await self._ensure_ttl(self.archive, 'day', STOCK_ARCHIVE_TTL_DAYS * 86400)
+        else:
+            await self.archive.create_index([('day', ASCENDING)])
+
+    @staticmethod
+    async def _ensure_ttl(collection: AsyncIOMotorCollection, field: str, seconds: int, **kwargs):
+        """TTL-индекс; при смене срока в настройках обновляет существующий через collMod"""
+        try:
+            await collection.create_index([(field, ASCENDING)], expireAfterSeconds=seconds, **kwargs)
+        except OperationFailure as e:
+            if e.code != INDEX_OPTIONS_CONFLICT:
+                raise
+            await collection.database.command({
+                'collMod': collection.name,
+                'index': {'keyPattern': {field: 1}, 'expireAfterSeconds': seconds}
+            })
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                archived = await self.archive_old_stocks()
+                if archived:
+                    logger.info(f"🗄️ В архив перенесено {archived} стоков")
+            except PyMongoError as e:
+                logger.error(f"❌ Ошибка архивации стоков: {e}")
+            await asyncio.sleep(STOCK_ARCHIVE_INTERVAL)
+
+    async def archive_old_stocks(self) -> int:
+        """Перенести в архив все стоки старше горячего окна. Возвращает их число."""
+        cutoff = datetime.utcnow() - timedelta(hours=STOCK_HOT_RETENTION_HOURS)
+        archived = 0
+        while True:
+            stocks = await self.stocks.find(
+                {'created_at': {'$lt': cutoff}, 'archived_at': {'$exists': False}}
+            ).sort('created_at', ASCENDING).limit(STOCK_ARCHIVE_BATCH_SIZE).to_list(length=STOCK_ARCHIVE_BATCH_SIZE)
+            if not stocks:
+                return archived
+            await self._write_buckets(stocks)
+            await self.stocks.update_many(
+                {'_id': {'$in': [stock['_id'] for stock in stocks]}},
+                {'$set': {'archived_at': datetime.utcnow()}}
+            )
+            archived += len(stocks)
+
+    async def _write_buckets(self, stocks: List[dict]):
+        # Сначала создаем бакеты дней, затем дописываем в них стоки без upsert
+        days = {day_start(stock['created_at']) for stock in stocks}
+        operations = [
+            UpdateOne(
+                {'_id': day.strftime('%Y-%m-%d')},
+                {'$setOnInsert': {'day': day, 'count': 0, 'stocks': [], 'items': {}}},
+                upsert=True
+            )
+            for day in sorted(days)
+        ]
+        for stock in stocks:
+            created_at = stock['created_at']
+            day = day_start(created_at)
+            seeds_stock = stock.get('seeds_stock', {})
+            gear_stock = stock.get('gear_stock', {})
+
+            counters: Dict[str, int] = {'count': 1}
+            for item_type, items in (('seed', seeds_stock), ('gear', gear_stock)):
+                for name, quantity in items.items():
+                    key = item_key(name, item_type)
+                    counters[f'items.{key}.appearances'] = counters.get(f'items.{key}.appearances', 0) + 1
+                    counters[f'items.{key}.quantity'] = counters.get(f'items.{key}.quantity', 0) + int(quantity or 0)
+
+            # Условие по stocks._id делает запись идемпотентной: при повторе после сбоя
+            # уже записанный сток не посчитается дважды
+            operations.append(UpdateOne(
+                {'_id': day.strftime('%Y-%m-%d'), 'stocks._id': {'$ne': stock['_id']}},
+                {
+                    '$push': {'stocks': {
+                        '_id': stock['_id'],
+                        'created_at': created_at,
+                        'seeds_stock': seeds_stock,
+                        'gear_stock': gear_stock,
+                    }},
+                    '$inc': counters,
+                    '$min': {'first_at': created_at},
+                    '$max': {'last_at': created_at},
+                }
+            ))
+        await self.archive.bulk_write(operations, ordered=True)
@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import PyMongoError
+
+from app.common.items import items_to_mask
+
+logger = logging.getLogger(__name__)
+
+# Интервал инкрементального опроса, если change stream недоступен (standalone MongoDB)
+SUBSCRIPTION_POLL_INTERVAL = float(os.getenv('SUBSCRIPTION_POLL_INTERVAL', '5'))
+# Интервал полной перестройки индекса (страховка от пропущенных событий)
+SUBSCRIPTION_FULL_REBUILD_INTERVAL = float(os.getenv('SUBSCRIPTION_FULL_REBUILD_INTERVAL', '600'))
+# Размер батча курсора при загрузке подписок
+SUBSCRIPTION_BATCH_SIZE = 5000
+
+SUBSCRIPTION_PROJECTION = {'user_id': 1, 'items': 1, 'items_mask': 1, 'updated_at': 1}
+
+
+def doc_mask(doc: dict) -> int:
+    """Маска подписок документа (для старых документов считается по items)"""
+    mask = doc.get('items_mask')
+    if mask is None:
+        mask = items_to_mask(doc.get('items') or ())
+    return int(mask)
+
+
+class SubscriptionIndex:
+    """Индекс подписок в виде битовых масок.
+
+    Маски пользователей лежат в массиве numpy uint64, поэтому поиск всех
+    подписчиков для стока - одна векторная операция & по всем пользователям.
+    """
+
+    def __init__(
+        self,
+        collection: AsyncIOMotorCollection,
+        on_subscribed: Optional[Callable[[int, Optional[datetime]], None]] = None,
+    ):
+        self.collection = collection
+        # Вызывается для каждого документа с непустыми подписками (user_id, updated_at)
+        self.on_subscribed = on_subscribed
+        self.user_ids = np.zeros(0, dtype=np.int64)
+        self.masks = np.zeros(0, dtype=np.uint64)
+        self.size = 0
+        # user_id -> строка в массивах
+        self.rows: Dict[int, int] = {}
+        # _id документа -> user_id, нужно для обработки delete-событий change stream
+        self.doc_users: Dict[object, int] = {}
+        self.active_users = 0
+        self.last_updated_at: Optional[datetime] = None
+        self.ready = False
+        self._follow_task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return self.active_users
+
+    async def start(self):
+        """Первичная загрузка индекса и запуск фонового обновления"""
+        if self._follow_task is not None:
+            return
+        await self.rebuild()
+        self._follow_task = asyncio.create_task(self._follow())
+
+    async def rebuild(self):
+        """Полная перестройка индекса из plant_subscriptions"""
+        user_ids = []
+        masks = []
+        doc_users: Dict[object, int] = {}
+        last_updated_at = None
+
+        cursor = self.collection.find(
+            {'items': {'$exists': True, '$ne': []}},
+            SUBSCRIPTION_PROJECTION,
+            batch_size=SUBSCRIPTION_BATCH_SIZE
+        )
+        async for doc in cursor:
+            user_id = doc.get('user_id')
+            mask = doc_mask(doc)
+            if not user_id or not mask:
+                continue
+            user_ids.append(user_id)
+            masks.append(mask)
+            doc_users[doc['_id']] = user_id
+            updated_at = doc.get('updated_at')
+            if self.on_subscribed:
+                self.on_subscribed(user_id, updated_at)
+            if updated_at and (last_updated_at is None or updated_at > last_updated_at):
+                last_updated_at = updated_at
+
+        self.user_ids = np.array(user_ids, dtype=np.int64)
+        self.masks = np.array(masks, dtype=np.uint64)
+        self.size = len(user_ids)
+        self.rows = {user_id: row for row, user_id in enumerate(user_ids)}
+        self.doc_users = doc_users
+        self.active_users = self.size
+        self.last_updated_at = last_updated_at
+        self.ready = True
+
+    def update_user(self, user_id: int, mask: int, doc_id=None):
+        """Заменить маску подписок пользователя"""
+        row = self.rows.get(user_id)
+        if row is None:
+            if not mask:
+                return
+            row = self._append_row(user_id)
+        old_mask = int(self.masks[row])
+        self.masks[row] = mask
+        if old_mask and not mask:
+            self.active_users -= 1
+        elif mask and not old_mask:
+            self.active_users += 1
+        if doc_id is not None:
+            self.doc_users[doc_id] = user_id
+
+    def _append_row(self, user_id: int) -> int:
+        # Емкость массивов растет удвоением, освободившиеся строки чистит rebuild
+        if self.size == len(self.masks):
+            capacity = max(1024, len(self.masks) * 2)
+            user_ids = np.zeros(capacity, dtype=np.int64)
+            user_ids[:self.size] = self.user_ids[:self.size]
+            masks = np.zeros(capacity, dtype=np.uint64)
+            masks[:self.size] = self.masks[:self.size]
+            self.user_ids = user_ids
+            self.masks = masks
+        row = self.size
+        self.user_ids[row] = user_id
+        self.masks[row] = 0
+        self.rows[user_id] = row
+        self.size += 1
+        return row
+
+    def remove_user(self, user_id: int):
+        """Удалить пользователя из индекса"""
+        self.update_user(user_id, 0)
+
+    def remove_doc(self, doc_id):
+        """Удалить пользователя по _id документа подписки"""
+        user_id = self.doc_users.pop(doc_id, None)
+        if user_id is not None:
+            self.remove_user(user_id)
+
+    def match(self, stock_mask: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Пользователи с пересечением подписок и стока.
+
+        Возвращает массивы user_id и масок совпавших предметов.
+        """
+        matched = self.masks[:self.size] & np.uint64(stock_mask)
+        hits = np.flatnonzero(matched)
+        return self.user_ids[hits], matched[hits]
+
+    def _apply_doc(self, doc: dict):
+        user_id = doc.get('user_id')
+        if not user_id:
+            return
+        mask = doc_mask(doc)
+        self.update_user(user_id, mask, doc_id=doc.get('_id'))
+        updated_at = doc.get('updated_at')
+        if mask and self.on_subscribed:
+            self.on_subscribed(user_id, updated_at)
+        if updated_at and (self.last_updated_at is None or updated_at > self.last_updated_at):
+            self.last_updated_at = updated_at
+
+    async def _follow(self):
+        """Держит индекс актуальным: change stream, при недоступности - опрос"""
+        try:
+            await self._watch()
+        except PyMongoError as e:
+            logger.warning(f"⚠️ Change stream для подписок недоступен ({e}), переключаюсь на опрос")
+        await self._poll()
+
+    async def _watch(self):
+        pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace', 'delete']}}}]
+        async with self.collection.watch(pipeline, full_document='updateLookup') as stream:
+            logger.info("✅ Индекс подписок отслеживает change stream")
+            async for change in stream:
+                if change['operationType'] == 'delete':
+                    self.remove_doc(change['documentKey']['_id'])
+                    continue
+                doc = change.get('fullDocument')
+                if doc is None:
+                    # Документ удален до updateLookup
+                    self.remove_doc(change['documentKey']['_id'])
+                else:
+                    self._apply_doc(doc)
+
+    async def _poll(self):
+        loop = asyncio.get_running_loop()
+        last_rebuild = loop.time()
+        while True:
+            await asyncio.sleep(SUBSCRIPTION_POLL_INTERVAL)
+            try:
+                if loop.time() - last_rebuild >= SUBSCRIPTION_FULL_REBUILD_INTERVAL:
+                    await self.rebuild()
+                    last_rebuild = loop.time()
+                    continue
+
+                query = {}
+                if self.last_updated_at is not None:
+                    query['updated_at'] = {'$gt': self.last_updated_at}
+                cursor = self.collection.find(
+                    query,
+                    SUBSCRIPTION_PROJECTION,
+                    batch_size=SUBSCRIPTION_BATCH_SIZE
+                )
+                async for doc in cursor:
+                    self._apply_doc(doc)
+            except PyMongoError as e:
+                logger.error(f"❌ Ошибка обновления индекса подписок: {e}")